@@ -0,0 +1,51 @@
+import subprocess
+import sys
+from time import perf_counter
+
+'''
+What the bench_*.py scripts share. Each measurement runs in a process of its own (see measure()),
+which builds and runs the emulator the way ./run does (see emulate()), but without writing
+performance.csv or clearing and filling records/, so a benchmark leaves the directory as it was.
+'''
+
+# Builds the emulator for the options of emulator.py in this process and runs it. setup(common, m),
+# if given, runs before the design is built on m (the FPGA common.build_fpga() makes for the
+# options), to replace parts of common.py or of m. The exceptions in stop end the run early. Returns
+# the emulator.Emulator, the results of its run() (None if the run was stopped) and the seconds spent
+# in m.clock()
+def emulate(options, setup=None, stop=()):
+    import system
+    config = system.parse_config(options)
+    import common
+    common.configure(config)
+    m = common.build_fpga(common.args)
+    if setup is not None:
+        setup(common, m)
+    # the modules of the design import the records of common.py, so not before setup() has run
+    import emulator
+
+    elapsed = 0.0
+    clock = m.clock
+    def timed():
+        nonlocal elapsed
+        start = perf_counter()
+        clock()
+        elapsed += perf_counter() - start
+    m.clock = timed
+
+    design = emulator.Emulator(config, m, records=False)
+    try:
+        results = design.run()
+        design.report(results)
+    except stop:
+        results = None
+    return design, results, elapsed
+
+# prints the line measure() reads the values of a measurement from
+def result(*values):
+    print("RESULT", *values)
+
+# runs script with args in a new process and returns the values it passed to result(), as strings
+def measure(script, args):
+    out = subprocess.run([sys.executable, script] + args, capture_output=True, text=True).stdout
+    return out.strip().split("\n")[-1].split()[1:]
@@ -0,0 +1,106 @@
+import sys
+from time import perf_counter
+
+import bench
+from hls import *
+
+'''
+Cycles skipped by --fast-forward (MockFPGA(fast_forward=True), see MockFPGA.skip_idle) and the time
+it saves over plain --event-driven.
+
+The first rows are a drain-heavy netlist: a token goes around a loop through a pipeline DEPTH
+stages deep ROUNDS times, so on nearly every cycle the only activity is the pipeline shifting NULL
+entries along. The others are emulator.py, each run in its own process. Its rings and the phase 3
+update sweep do work on nearly every cycle, so only the force pipelines draining at the end of
+phase 1 are skipped, and the fewer particles there are, the larger that share of the cycles.
+
+usage: python bench_fast_forward.py
+'''
+
+DEPTH = 500
+ROUNDS = 100
+
+EMULATOR = [["-u", "3", "-n", "5", "-t", "1"], ["-u", "3", "-n", "100", "-t", "1"]]
+
+# emits a token on the first cycle and the next one whenever the last one comes back (the Register
+# closing the loop keeps the last token it got), until rounds tokens went around
+class Loop(Logic):
+    def __init__(self, rounds):
+        super().__init__("loop")
+        self.i = Input(self, "i")
+        self.o = Output(self, "o")
+        self._sent = None
+        self._rounds = rounds
+
+    def logic(self):
+        if self._sent is None or (self.i.get() == self._sent and self._rounds):
+            self._sent = 0 if self._sent is None else self._sent + 1
+            self._rounds -= 1
+            self.o.set(self._sent)
+        else:
+            self.o.set(NULL)
+
+    # the token is only driven for one cycle
+    def has_pending_work(self):
+        return self._sent is None or self.o.val is not NULL
+
+# passes i on to o depth cycles later
+class Delay(Logic):
+    def __init__(self, depth):
+        super().__init__("delay")
+        self.i = Input(self, "i")
+        self.o = Output(self, "o")
+        self.pipeline(depth)
+
+    def logic(self):
+        self.o.set(self.i.get())
+
+    def has_pending_work(self):
+        return False
+
+def drain(fast_forward):
+    m = MockFPGA(event_driven=True, fast_forward=fast_forward)
+    loop = m.add(Loop(ROUNDS))
+    delay = m.add(Delay(DEPTH))
+    reg = m.add(Register("token"))
+    connect(loop.o, delay.i)
+    connect(delay.o, reg.i)
+    connect(reg.o, loop.i)
+
+    calls = 0
+    start = perf_counter()
+    while loop._rounds or delay._n:
+        m.clock()
+        calls += 1
+    return m.clock_total, m.cycles_skipped, calls, perf_counter() - start
+
+def run(options):
+    calls = 0
+    def setup(common, m):
+        clock = m.clock
+        def counted():
+            nonlocal calls
+            calls += 1
+            clock()
+        m.clock = counted
+    design, results, elapsed = bench.emulate(options, setup)
+    bench.result(design.m.clock_total, design.m.cycles_skipped, calls, elapsed)
+
+def report(name, cycles, skipped, calls, elapsed, base):
+    print(f"{name:<44} {cycles:>7} {calls:>8} {skipped:>8} {100 * skipped / cycles:>7.1f}% {elapsed:>8.3f} {base / elapsed:>6.2f}x")
+
+if len(sys.argv) > 1 and sys.argv[1] == "run":
+    run(sys.argv[2:])
+else:
+    print(f"{'':<44} {'cycles':>7} {'clock()':>8} {'skipped':>8} {'':>8} {'time (s)':>8} {'':>7}")
+    base = None
+    for fast_forward in [False, True]:
+        cycles, skipped, calls, elapsed = drain(fast_forward)
+        base = base or elapsed
+        report(f"loop through {DEPTH} stages {'--fast-forward' if fast_forward else '--event-driven'}", cycles, skipped, calls, elapsed, base)
+    for options in EMULATOR:
+        base = None
+        for flag in ["--event-driven", "--fast-forward"]:
+            cycles, skipped, calls, elapsed = bench.measure(__file__, ["run"] + options + [flag])
+            base = base or float(elapsed)
+            report(f"emulator.py {' '.join(options)} {flag}", int(cycles), int(skipped), int(calls), float(elapsed), base)
@@ -0,0 +1,36 @@
+import sys
+
+import bench
+
+'''
+Accuracy of the tabulated LJ forces (--lj-table, see common.LJTable) against the exact ones, and what
+they do to the emulator. For each table configuration emulator.py runs in its own process with the
+force pipelines reading the table and the verifier computing exact forces, and reports the table's
+size and error (relative to LJ_MAX), cycles_total, max_err and the time spent in m.clock(). The first
+row is the exact forces everywhere.
+
+usage: python bench_lj_table.py [emulator options]
+'''
+
+ARGS = ["-u", "3", "-n", "100", "-t", "2"]
+
+# (bins per segment, segments, order)
+TABLES = [None, (16, 8, 0), (64, 8, 0), (16, 8, 1), (64, 8, 1), (256, 8, 1), (16, 8, 2), (16, 8, 3), (64, 4, 1)]
+
+def run(options):
+    design, results, elapsed = bench.emulate(options)
+    import common
+    table = common.LJ_TABLE
+    size, error = (table.coefficients.size, table.error()) if table is not None else (0, 0.)
+    bench.result(size, error, results[0][1], results[0][2], elapsed)
+
+if len(sys.argv) > 1 and sys.argv[1] == "run":
+    run(sys.argv[2:])
+else:
+    args = sys.argv[1:] or ARGS
+    print(f"{'bins':>5} {'segments':>8} {'order':>5} {'words':>6} {'error':>9} {'cycles':>7} {'max_err':>22} {'clock() (s)':>11}")
+    for table in TABLES:
+        options = [] if table is None else ["--lj-table", str(table[0]), "--lj-segments", str(table[1]), "--lj-order", str(table[2])]
+        size, error, cycles, max_err, elapsed = bench.measure(__file__, ["run"] + args + options)
+        bins, segments, order = table if table is not None else ("exact", "", "")
+        print(f"{bins:>5} {segments:>8} {order:>5} {size:>6} {float(error):>9.2e} {cycles:>7} {float(max_err):>22} {float(elapsed):>11.2f}")
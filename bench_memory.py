@@ -0,0 +1,51 @@
+import argparse
+import resource
+import sys
+
+import bench
+
+'''
+Peak resident memory of ./run against UNIVERSE_SIZE. For each size a separate process builds the
+netlist, places the particles, computes the verifier's expectations for the first timestep and runs
+the first CYCLES clock cycles, then reports its peak RSS (ru_maxrss). The netlist and the particles
+are all allocated by then, so later cycles only add the transient values on the wires.
+
+The particle count is the same for every size (-n, 300 like emulator.py), so the growth is the
+netlist's. --density scales it with the number of cells instead, which makes the verifier's O(N^2)
+reference timestep take most of the run time.
+
+usage: python bench_memory.py [-n N_PARTICLE | --density PER_CELL] [UNIVERSE_SIZE ...]
+'''
+
+SIZES = [3, 4, 5, 6, 7, 8]
+CYCLES = 50
+
+class Done(Exception):
+    pass
+
+def setup(common, m):
+    clock = m.clock
+    def limited():
+        if m.clock_total == CYCLES:
+            raise Done
+        clock()
+    m.clock = limited
+
+def run(size, particles):
+    design, results, elapsed = bench.emulate(["-u", str(size), "-n", str(particles), "-t", "1"], setup, Done)
+    bench.result(len(design.m.units), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+if len(sys.argv) == 4 and sys.argv[1] == "run":
+    run(int(sys.argv[2]), int(sys.argv[3]))
+else:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sizes", type=int, nargs="*", default=SIZES)
+    parser.add_argument("-n", "--particles", type=int, default=300)
+    parser.add_argument("--density", type=float, default=None) # particles per cell
+    args = parser.parse_args()
+
+    print(f"{'UNIVERSE_SIZE':>13} {'N_PARTICLE':>10} {'units':>8} {'peak RSS (MB)':>14}")
+    for size in args.sizes:
+        particles = args.particles if args.density is None else round(args.density * size**3)
+        units, rss = bench.measure(__file__, ["run", str(size), str(particles)])
+        print(f"{size:>13} {particles:>10} {units:>8} {int(rss) / 1024:>14.1f}")
@@ -0,0 +1,93 @@
+import sys
+import tracemalloc
+
+import bench
+
+'''
+Allocations for the particle records of one timestep of emulator.py -u 3 -n 100, with the slotted
+Position, Velocity and Acceleration records of common.py and with a copy of the Struct they replaced,
+which had a slot for each of r, v and a, named the one in use with a string and set it with setattr().
+
+Each version runs twice, in its own processes: once counting the records created and the memory
+traced by tracemalloc while the FPGA is clocked (its peak, which the records in flight are part of),
+and once timing m.clock() without tracemalloc.
+
+usage: python bench_particles.py
+'''
+
+ARGS = ["-u", "3", "-n", "100", "-t", "1"]
+
+# the particle records before they were split by kind
+class Struct:
+    # ident is the name of the one of r, v and a that holds the data
+    __slots__ = ("cell", "addr", "ident", "r", "v", "a")
+
+    def __init__(self, data, addr, cell, ident):
+        self.cell = cell # cell of origin
+        self.addr = addr # addr of origin
+        self.ident = ident # an identifier for the attribute that will hold the actual data
+        setattr(self, ident, data)
+
+    def __eq__(self, obj):
+        return self.ident == obj.ident and self.cell == obj.cell and self.addr == obj.addr
+
+def install_legacy(common):
+    common.Position = lambda r, addr, cell: Struct(r, addr, cell, "r")
+    common.Velocity = lambda v, addr, cell: Struct(v, addr, cell, "v")
+    common.Acceleration = lambda a, addr, cell: Struct(a, addr, cell, "a")
+
+# replaces the record constructors with ones that count the records they create
+def count_records(common):
+    created = {}
+    sizes = {}
+    def counted(kind, make):
+        created[kind] = 0
+        def record(*args, **kwargs):
+            created[kind] += 1
+            p = make(*args, **kwargs)
+            sizes[kind] = sys.getsizeof(p)
+            return p
+        return record
+    for kind in ["Position", "Velocity", "Acceleration"]:
+        setattr(common, kind, counted(kind, getattr(common, kind)))
+    return created, sizes
+
+def run(version, measure):
+    created, sizes = {}, {}
+    peak = 0
+    def setup(common, m):
+        nonlocal created, sizes
+        if version == "legacy":
+            install_legacy(common)
+        if measure == "alloc":
+            # the modules that build records import these names from common when emulator.py imports them
+            created, sizes = count_records(common)
+            clock = m.clock
+            def traced():
+                nonlocal peak
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                clock()
+                peak = tracemalloc.get_traced_memory()[1]
+            m.clock = traced
+
+    design, results, elapsed = bench.emulate(ARGS, setup)
+    if measure == "alloc":
+        records = sum(created.values())
+        size = sum([created[kind] * sizes.get(kind, 0) for kind in created])
+        bench.result(design.m.clock_total, records, size, peak)
+    else:
+        bench.result(design.m.clock_total, elapsed)
+
+def result(version, measure):
+    return bench.measure(__file__, [version, measure])
+
+if len(sys.argv) == 3 and sys.argv[1] in ("legacy", "records"):
+    run(sys.argv[1], sys.argv[2])
+else:
+    for version in ["legacy", "records"]:
+        cycles, records, size, peak = result(version, "alloc")
+        elapsed = float(result(version, "time")[1])
+        print(f"{version}: {cycles} cycles, {records} records of {int(size) / int(records):.0f} bytes "
+              f"({int(size) / 2**20:.2f} MB), peak traced {int(peak) / 2**20:.2f} MB, "
+              f"{elapsed:.2f}s in clock()")
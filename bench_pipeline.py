@@ -0,0 +1,78 @@
+from collections import deque
+from time import perf_counter
+import tracemalloc
+
+from hls import *
+from compute_pipeline import ForcePipeline, ParticleFilter
+
+'''
+Microbenchmark of the pipeline shift done by Logic.__call__ for the two deeply pipelined units.
+
+Each unit is evaluated with NULL inputs (a drained pipeline, the common case) using Logic.__call__
+(Pipeline, preallocated ring buffer) and using a copy of the shift Logic.__call__ used to do (a deque
+of freshly allocated lists and two scans over the Outputs per cycle). Reports the time per evaluation
+and the memory allocated during each evaluation once the pipeline is full.
+'''
+
+ITERATIONS = 20000
+
+class Source(Logic):
+    def __init__(self, n):
+        super().__init__("source")
+        self.o = [Output(self, f"o{k}") for k in range(n)]
+        for o in self.o:
+            o.val = NULL
+
+    def logic(self):
+        pass
+
+# Logic.__call__ before Pipeline, minus the checks and printing both versions share
+def deque_call(unit):
+    for o in unit._outputs:
+        o.val = None
+    unit.logic()
+    unit.empty.set(NULL)
+
+    unit._queue.append([o.val for o in unit._outputs])
+    if any([o.val is not NULL for o in unit._outputs]):
+        unit._n += 1
+    for o, val in zip(unit._outputs, unit._queue.popleft()):
+        o.val = val
+    if any([o.val is not NULL for o in unit._outputs]):
+        unit._n -= 1
+    unit.empty.val = unit._n == 0
+
+def build(cls):
+    unit = cls(0)
+    source = Source(len(unit._inputs))
+    for o, i in zip(source.o, unit._inputs):
+        connect(o, i)
+    unit._queue = deque([[NULL for _ in unit._outputs] for _ in range(len(unit._pipeline))])
+    return unit
+
+def measure(f):
+    for _ in range(ITERATIONS):
+        f()
+    start = perf_counter()
+    for _ in range(ITERATIONS):
+        f()
+    elapsed = perf_counter() - start
+
+    # memory allocated while evaluating (freed again by the end of the evaluation for both versions)
+    tracemalloc.start()
+    transient = 0
+    for _ in range(1000):
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        f()
+        _, peak = tracemalloc.get_traced_memory()
+        transient += peak - current
+    tracemalloc.stop()
+    return elapsed / ITERATIONS * 1e9, transient / 1000
+
+for name, cls in [("ForcePipeline", ForcePipeline), ("ParticleFilter", ParticleFilter)]:
+    unit = build(cls)
+    t_deque, a_deque = measure(lambda: deque_call(unit))
+    t_ring, a_ring = measure(unit)
+    print(f"{name} ({len(unit._pipeline)} stages): deque {t_deque:.0f} ns/cycle, {a_deque:.0f} bytes allocated/cycle; "
+          f"Pipeline {t_ring:.0f} ns/cycle, {a_ring:.0f} bytes allocated/cycle ({t_deque / t_ring:.2f}x)")
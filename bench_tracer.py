@@ -0,0 +1,119 @@
+import sys
+
+import bench
+
+'''
+Cycles per second of ./run (emulator.py -u 4, one timestep) with the engine's port and evaluation
+methods as they are (no Tracer bound) and with copies of the versions they replaced, which formatted
+a debug() message, updated the global nesting counter and checked CONFIG_VERBOSE on every call.
+
+Each version runs in its own process. Only the time spent in m.clock() counts.
+'''
+
+ARGS = ["-u", "4", "-t", "1"]
+
+# the hot path before tracing was split out into hls.Tracer
+CONFIG_VERBOSE = False
+dioi = 0
+di = lambda: "."*dioi
+def debug(*args, **kwargs):
+    if CONFIG_VERBOSE:
+        print(*args,**kwargs)
+
+def install_legacy():
+    from hls import Input, Output, Register, BRAM, Logic, NULL, RESET, builtin
+
+    def input_call(self):
+        global dioi
+        dioi += 1
+        debug(di() + "reading input", self.name)
+        val = self.output.val
+        dioi -= 1
+        assert val is not None, f"{self.name} read None from Output {self.output.name}"
+        return val
+
+    def input_get(self):
+        return self()
+
+    def output_call(self):
+        debug(di() + "reading output", self.name)
+        assert self.val is not None
+        return self.val
+
+    def output_set(self, val):
+        debug("writing", self.name)
+        assert self.val is None, f"{self.name} is being set twice"
+        self.val = val
+
+    def register_write(self):
+        i = self.i()
+        if i is not NULL:
+            if i is RESET:
+                if self.verbose:
+                    print(f"Resetting register {self.name}")
+                i = NULL
+            self.contents = i
+        if self.verbose:
+            print(self.name)
+
+    def bram_call(self):
+        oaddr = self.oaddr()
+        if oaddr is not NULL:
+            self.o.val = self.contents[oaddr]
+        else:
+            self.o.val = NULL
+        if self.verbose:
+            print(f"{self.name}:")
+
+    def logic_call(self):
+        debug(di() + f"Evaluating {self.name}")
+        if self.debug:
+            breakpoint()
+        for o in self._outputs:
+            o.val = None
+        self.logic()
+        self.empty.set(NULL)
+
+        for o in self._outputs:
+            passed = True
+            if o.val is None:
+                print(f"{o.name} is None after calling parent logic")
+                passed = False
+            if not passed:
+                print(f"ERROR: Must set all Outputs to non-None in {self.name}.logic()")
+                exit(1)
+
+        if self._pipeline.depth:
+            change = self._pipeline.shift()
+            if change:
+                self._n += change
+
+        self.empty.val = self._n == 0
+
+        if self.verbose:
+            print(f"{self.name}:")
+
+    Input.__call__ = input_call
+    Input.get = input_get
+    Output.__call__ = output_call
+    Output.set = output_set
+    Register.write = register_write
+    BRAM.__call__ = bram_call
+    Logic.__call__ = logic_call
+
+def setup(common, m):
+    m.bind_tracer = install_legacy
+
+def run(version):
+    design, results, elapsed = bench.emulate(ARGS, setup if version == "legacy" else None)
+    bench.result(design.m.clock_total, elapsed)
+
+if len(sys.argv) == 2 and sys.argv[1] in ("legacy", "plain"):
+    run(sys.argv[1])
+else:
+    rates = {}
+    for version in ["legacy", "plain"]:
+        cycles, elapsed = bench.measure(__file__, [version])
+        rates[version] = int(cycles) / float(elapsed)
+        print(f"{version}: {cycles} cycles, {float(elapsed):.2f}s in clock(), {rates[version]:.1f} cycles/s")
+    print(f"{rates['plain'] / rates['legacy']:.2f}x")
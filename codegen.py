@@ -0,0 +1,230 @@
+import hashlib
+import marshal
+import os
+import pickle
+import sys
+
+from hls import *
+
+'''
+Alternative MockFPGA backend: generates a Python module with a straight-line step() that evaluates a
+validated netlist for a single cycle. It is selected with MockFPGA(backend="codegen").
+
+The schedule is written out in blocks of BLOCK units, each a function of its own, and step() calls
+them in order. Every unit, Output and pipeline is bound to a local variable of its block, so a wire is
+read straight off the Output driving it. Register and BRAM reads and writes, clearing and checking
+Outputs, the empty signal, pipeline shifting and gating are all written out. Logic.logic() is still
+called for each unit, but the MockFPGA binds plain attribute reads and writes as the Input.get() and
+Output.set() of its ports (see MockFPGA.bind_ports), so logic() skips the generic port wrappers.
+
+Compiling the module takes far longer than generating it, so the compiled code is kept in the
+MockFPGA's cache_dir under the hash of the source, and a design is only compiled once.
+
+If a Tracer is bound (see MockFPGA.bind_tracer, e.g. because a unit has verbose or debug set), step()
+calls the MockFPGA's steps and writers instead, so every evaluation and write goes through it.
+'''
+
+# Units (or storage writes) per block. A single function over the whole netlist has a local for each
+# of its thousands of objects, and compiles about four times slower than the same code in blocks
+BLOCK = 100
+
+# reports a unit that left an Output unset, like Logic.__call__ does
+def missing(unit):
+    for o in unit._outputs:
+        if o.val is None:
+            print(f"{o.name} is None after calling parent logic")
+    print(f"ERROR: Must set all Outputs to non-None in {unit.name}.logic()")
+    exit(1)
+
+class Generator:
+    def __init__(self, m):
+        self.m = m
+        self.objects = []
+        self.names = {}
+        self.lines = []
+        self.used = {} # name -> index in objects of the locals the current block refers to
+        self.blocks = [] # (lines, used) of each finished block
+
+    # name of the local variable holding obj
+    def ref(self, obj, prefix):
+        name = self.names.get(id(obj))
+        if name is None:
+            name = f"{prefix}{len(self.objects)}"
+            self.names[id(obj)] = name
+            self.objects.append(obj)
+        self.used[name] = int(name[1:])
+        return name
+
+    # ends the current block, every BLOCK units
+    def block(self, k=0):
+        if k % BLOCK == 0 and len(self.lines):
+            self.blocks.append((self.lines, self.used))
+            self.lines = []
+            self.used = {}
+
+    def emit(self, line, depth=1):
+        self.lines.append("    " * depth + line)
+
+    # expression for the value currently on the wire feeding Input i
+    def wire(self, i):
+        return f"{self.ref(i.output, 'o')}.val"
+
+    def register_read(self, unit):
+        self.emit(f"{self.ref(unit.o, 'o')}.val = {self.ref(unit, 'r')}.contents")
+
+    def register_write(self, unit):
+        self.emit(f"v = {self.wire(unit.i)}")
+        self.emit(f"if v is not NULL:")
+        self.emit(f"{self.ref(unit, 'r')}.contents = NULL if v is RESET else v", 2)
+
+    def bram_read(self, unit, depth):
+        self.emit(f"a = {self.wire(unit.oaddr)}", depth)
+        self.emit(f"{self.ref(unit.o, 'o')}.val = NULL if a is NULL else {self.ref(unit, 'b')}.contents[a]", depth)
+
+    def bram_write(self, unit):
+        self.emit(f"v = {self.wire(unit.i)}")
+        self.emit(f"a = {self.wire(unit.iaddr)}")
+        self.emit(f"if v is not NULL and a is not NULL:")
+        self.emit(f"{self.ref(unit, 'b')}.contents[a] = NULL if v is RESET else v", 2)
+
+    def logic(self, unit, depth):
+        u = self.ref(unit, "u")
+        outputs = [o for o in unit._outputs if o is not unit.empty]
+        names = [self.ref(o, "o") for o in outputs]
+        for o in names:
+            self.emit(f"{o}.val = None", depth)
+        self.emit(f"{u}.logic()", depth)
+        if len(names):
+            self.emit(f"if {' or '.join([f'{o}.val is None' for o in names])}:", depth)
+            self.emit(f"missing({u})", depth + 1)
+
+        empty = self.ref(unit.empty, "o")
+        if len(unit._pipeline) == 0 or len(names) == 0:
+            self.emit(f"{empty}.val = True", depth)
+            return
+
+        # Pipeline.shift() written out
+        pipeline = unit._pipeline
+        p = self.ref(pipeline, "p")
+        ports = [(self.ref(o, "o"), self.ref(column, "c")) for o, column in pipeline.ports]
+        self.emit(f"h = {p}.head", depth)
+        self.emit(f"busy = {' or '.join([f'{o}.val is not NULL' for o, _ in ports])}", depth)
+        for o, c in ports:
+            self.emit(f"v = {o}.val; {o}.val = {c}[h]; {c}[h] = v", depth)
+        self.emit(f"{p}.head = h + 1 if h != {pipeline.depth - 1} else 0", depth)
+        self.emit(f"b = {p}.busy", depth)
+        self.emit(f"if busy is not b[h]:", depth)
+        self.emit(f"{u}._n += busy - b[h]", depth + 1)
+        self.emit(f"b[h] = busy", depth + 1)
+        self.emit(f"{empty}.val = {u}._n == 0", depth)
+
+    # same states as hls.Gate
+    def gated(self, gate):
+        unit = gate.unit
+        g = self.ref(gate, "g")
+        self.emit(f"if {self.ref(gate.signal, 'o')}.val is True:")
+        self.emit(f"{g}.state = 0", 2)
+        self.emit(f"elif {g}.state == 0 or {self.ref(unit, 'u')}._n != 0:")
+        self.emit(f"{g}.state = 1", 2)
+        self.emit(f"elif {g}.state == 1:")
+        self.emit(f"{g}.state = 2", 2)
+        for o in unit._outputs:
+            self.emit(f"{self.ref(o, 'o')}.val = NULL", 2)
+        self.emit(f"if {g}.state != 2:")
+        self.logic(unit, 2)
+
+    # the engine's work written out (without a Tracer)
+    def untraced(self):
+        m = self.m
+        for k, (step, unit) in enumerate(zip(m._steps, m._schedule)):
+            self.block(k)
+            if type(unit) is Register:
+                self.register_read(unit)
+            elif type(unit) is BRAM:
+                self.bram_read(unit, 1)
+            elif step is not unit:
+                self.gated(step)
+            else:
+                self.logic(unit, 1)
+        self.block()
+        for k, unit in enumerate(m._storage):
+            self.block(k)
+            if type(unit) is Register:
+                self.register_write(unit)
+            else:
+                self.bram_write(unit)
+
+    # every evaluation and write through the MockFPGA's steps and writers (with a Tracer)
+    def traced(self):
+        m = self.m
+        for k, step in enumerate(m._steps):
+            self.block(k)
+            self.emit(f"{self.ref(step, 's')}()")
+        self.block()
+        for k, write in enumerate(m._writers):
+            self.block(k)
+            self.emit(f"{self.ref(write, 'w')}()")
+
+    def generate(self):
+        m = self.m
+        if m._tracer is not None:
+            self.traced()
+        else:
+            self.untraced()
+        self.block()
+
+        blocks = self.blocks
+        self.lines = []
+        self.emit(f"# generated by codegen.py from a netlist of {len(m.units)} units, in {len(blocks)} blocks", 0)
+        self.emit("from hls import NULL, RESET", 0)
+        self.emit("from codegen import missing", 0)
+        for k, (lines, used) in enumerate(blocks):
+            self.emit("", 0)
+            self.emit(f"def block{k}(O):", 0)
+            for name, index in sorted(used.items(), key=lambda item: item[1]):
+                self.emit(f"{name} = O[{index}]")
+            self.emit("")
+            self.emit("def step():")
+            for line in lines:
+                self.emit(line)
+            self.emit("return step")
+
+        self.emit("", 0)
+        self.emit("def bind(O):", 0)
+        for k in range(len(blocks)):
+            self.emit(f"step{k} = block{k}(O)")
+        self.emit("")
+        self.emit("def step():")
+        for k in range(len(blocks)):
+            self.emit(f"step{k}()", 2)
+        if len(blocks) == 0:
+            self.emit("pass", 2)
+        self.emit("return step")
+        return "\n".join(self.lines) + "\n"
+
+# Generates the module for a validated MockFPGA, writes it to path if given, and returns its step()
+def compile_step(m, path=None):
+    generator = Generator(m)
+    source = generator.generate()
+    if path is not None:
+        with open(path, "w") as fp:
+            fp.write(source)
+
+    filename = path or "<hls-codegen>"
+    code = None
+    if m.cache_dir is not None:
+        key = hashlib.sha256(f"{filename}\n{source}".encode()).hexdigest()
+        cache = os.path.join(m.cache_dir, f"codegen-v{CACHE_VERSION}-{sys.implementation.cache_tag}-{key}")
+        try:
+            with open(cache, "rb") as fp:
+                code = marshal.loads(pickle.load(fp))
+        except Exception:
+            code = None # missing or unreadable, it is compiled again
+    if code is None:
+        code = compile(source, filename, "exec")
+        if m.cache_dir is not None:
+            m.write_cache(cache, marshal.dumps(code))
+
+    namespace = {}
+    exec(code, namespace)
+    return namespace["bind"](generator.objects)
@@ -1,5 +1,5 @@
-import argparse
 from hls import *
+from partition import PartitionedFPGA
 import random
 from collections import deque
 from math import floor
@@ -9,6 +9,7 @@ from numpy.linalg import norm
 import os
 from os.path import dirname, join
 import shutil
+import system
 from random import random, seed
 
 '''
@@ -16,11 +17,11 @@ constants, structures, and variables to be used by the phase{1,2,3}.py files
 
 A few that will be of concern to you:
 
-m - the global MockFPGA object. All components (Registers, Logic), should be added to this via m.add(<component>)
+m - the MockFPGA the design is built on (see build_fpga()). All components (Registers, Logic), should be added to this via m.add(<component>)
 
-N_CELL - number of cells in the universe
+N_CELL - number of cells in the universe, for the configured Config (see configure())
 
-{p,a,v}_caches - array of BRAMS containing particle, acceleration, and velocity data respectively for each cell. len({p,a,v}_caches) == N_CELL
+Caches.{p,v}_caches - array of BRAMS containing particle and velocity data respectively for each cell. len({p,v}_caches) == N_CELL
 
 class Position, Velocity, and Acceleration - I found when trying to implement this myself that it was useful to package particle origin (cell, addr) in the same variable as the actual data.
 (note: do not write instances of these classes to the actual caches! Their origin is implicit in their actual address. Just write the floating point value)
@@ -28,46 +29,36 @@ class Position, Velocity, and Acceleration - I found when trying to implement th
 particleFilter and forcePipeline - these are instances of ParticleFilter and ForcePipeline. Because they are shared between phase 1 and 2, I have implemented them here. We only use one of each for simplicity (we may expand to more in the future). particleFilter expects two instances of Position, and forcePipeline produces a tuple of Accelerations
 '''
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-c","--cpar", type=int, default=9)
-parser.add_argument("-p","--ppar", type=int, default=4)
-parser.add_argument("-t","--time", type=int, default=2)
-parser.add_argument("-n","--particles", type=int, default=300)
-parser.add_argument("-u","--size", type=int, default=3)
-parser.add_argument("-s","--seed", type=int, default=0)
-args = parser.parse_args()
-
-
 # Emulator parameters
-T = args.time # number of timesteps to simulate
+CONFIG = None # the Config they are set for, see configure()
+args = None # all the options of emulator.py for it
+T = None # number of timesteps to simulate
 DT = 1e-7 # timestep length
-UNIVERSE_SIZE = args.size # size of one dimension of the universe
-N_PARTICLE = args.particles
+UNIVERSE_SIZE = None # size of one dimension of the universe
+N_PARTICLE = None
 EPSILON = 40 # LJ const
 SIGMA = 1 # LJ const
-SEED = args.seed # Random seed for particle initialization
+SEED = None # Random seed for particle initialization
 FORCE_PIPELINE_STAGES = 70 # depth of computation pipeline
 FILTER_PIPELINE_STAGES = 13  # depth of filter pipeline
 N_PIPELINE = 7 # for particle-mapping and uniform-spread, number of compute units working in parallel
 
-N_CPAR = args.cpar # particle parallelism
-N_PPAR = args.ppar # cell parallelism
+N_CPAR = None # particle parallelism
+N_PPAR = None # cell parallelism
 
 VERIFY_COMPUTED = True # At every timestep, use verify.compute_targets to compare the emulator's computations with what they should be
 ERR_TOLERANCE = 1e-2 # % error tolerance. The max permissable value of norm(target-computed)/norm(computed) for each computed acceleration, velocity, or position
 
 # constants
-NSIZE = None # size of cell neighborhood, computed below
+NSIZE = None # size of cell neighborhood, computed by configure()
 BSIZE = 512 # bram size
 DBSIZE = BSIZE//2 # double buffer buffer size
 
 # derrived from above
-N_CELL = UNIVERSE_SIZE ** 3 # total number of cells in universe
+N_CELL = None # total number of cells in universe
 CUTOFF = SIGMA * 2.5 # cutoff radius
-L = CUTOFF * UNIVERSE_SIZE # length of one side of the universe
-N_IDENT = N_CELL*BSIZE # maximum number of unique particles. Used for verification
-
-seed(SEED)
+L = None # length of one side of the universe
+N_IDENT = None # maximum number of unique particles. Used for verification
 
 # for debugging
 CYCLE = None
@@ -114,6 +105,52 @@ class CacheMux(Logic):
             for o in self.o:
                 o.set(NULL)
 
+    def has_pending_work(self):
+        return False
+
+# N_CELL CacheMuxes evaluated as one unit (see hls.LogicArray). replica(k) has the same ports as a CacheMux
+class CacheMuxArray(LogicArray):
+    def __init__(self, name, idents, prefixes, n):
+        super().__init__(name, n)
+
+        self.opts = []
+        for ident in idents:
+            ctl = InputArray(self, f"{ident}-ready", n)
+            setattr(self, f"{ident}_ready", ctl)
+
+            inputs = []
+            for prefix in prefixes:
+                i = InputArray(self, f"{prefix}-{ident}", n)
+                setattr(self, f"{prefix}_{ident}", i)
+                inputs.append(i)
+
+            self.opts.append([ctl, inputs])
+
+        self.o = []
+        for prefix in prefixes:
+            o = OutputArray(self, prefix, n)
+            setattr(self, prefix, o)
+            self.o.append(o)
+
+        self.nulls = numpy.full(n, NULL, dtype=object) # every replica selecting nothing, copied by logic()
+
+    # each option selects its inputs for the replicas it is ready for, with a mask over the replicas
+    def logic(self):
+        vals = [self.nulls.copy() for _ in self.o]
+        for ctl, inputs in self.opts:
+            ready = ctl.get()
+            if True not in ready:
+                continue
+            ready = numpy.fromiter(ready, dtype=object, count=self.n) == True
+            for i, val in zip(inputs, vals):
+                val[ready] = i.array()[ready]
+
+        for o, val in zip(self.o, vals):
+            o.set(val.tolist())
+
+    def has_pending_work(self):
+        return False
+
 # always writes NULL to self.o
 class NullConst(Logic):
     def __init__(self):
@@ -124,6 +161,9 @@ class NullConst(Logic):
     def logic(self):
         self.o.set(NULL)
 
+    def has_pending_work(self):
+        return False
+
 # always writes RESET to self.o
 class ResetConst(Logic):
     def __init__(self):
@@ -133,12 +173,21 @@ class ResetConst(Logic):
     def logic(self):
         self.o.set(RESET)
 
+    def has_pending_work(self):
+        return False
+
 
-# creates a new array of BRAMs along with the muxes necessary to access it between phases
-def init_bram(ident, mux_idents):
-    caches = [m.add(BRAM(512,f"{ident}-cache-{i}")) for i in range(N_CELL)]
-    imuxes = [m.add(CacheMux(f"{ident}-imux-{i}", mux_idents, ["i","iaddr"])) for i in range(N_CELL)]
-    omuxes = [m.add(CacheMux(f"{ident}-omux-{i}", mux_idents, ["oaddr"])) for i in range(N_CELL)]
+# creates a new array of BRAMs in m along with the muxes necessary to access it between phases
+def init_bram(m, ident, mux_idents):
+    caches = [m.add(BRAM(512,f"{ident}-cache-{i}", width=3 if args.array_bram else None)) for i in range(N_CELL)]
+    if args.vectorize:
+        imux = m.add(CacheMuxArray(f"{ident}-imux", mux_idents, ["i","iaddr"], N_CELL))
+        omux = m.add(CacheMuxArray(f"{ident}-omux", mux_idents, ["oaddr"], N_CELL))
+        imuxes = [imux.replica(i) for i in range(N_CELL)]
+        omuxes = [omux.replica(i) for i in range(N_CELL)]
+    else:
+        imuxes = [m.add(CacheMux(f"{ident}-imux-{i}", mux_idents, ["i","iaddr"])) for i in range(N_CELL)]
+        omuxes = [m.add(CacheMux(f"{ident}-omux-{i}", mux_idents, ["oaddr"])) for i in range(N_CELL)]
     for imux, omux, cache in zip(imuxes, omuxes, caches):
         connect(imux.i, cache.i)
         connect(imux.iaddr, cache.iaddr)
@@ -164,6 +213,13 @@ def modr(reference, neighbor):
         r[i] = modd(reference[i], neighbor[i], L)
     return r
 
+# modr() for many pairs at once: references and neighbors are (n, 3) arrays, or one of them a single
+# position. Positions are in [0, L), so rounding picks the same one of b - M, b and b + M as modd(),
+# ties included, and the difference is taken in the same order
+def modr_batch(references, neighbors):
+    shift = numpy.floor((neighbors - references) / L + 0.5) * L
+    return (neighbors - shift) - references
+
 # whether we should evaluate neighbor wrt reference under N3L half-shell method
 def n3l(reference,neighbor):
     if type(reference) is not numpy.ndarray:
@@ -209,29 +265,55 @@ def neighborhood(cell, full=False):
             for dk in range(-1,2):
                 if n3l_cell(0,linear_idx(di,dj,dk)) or full:
                     yield linear_idx(i+di, j+dj, k+dk)
-NSIZE = sum([1 for _ in neighborhood(0)])
-print(NSIZE)
-
-# structs to hold particle data while it's passing through pipelines
-class Struct:
-    def __init__(self, data, addr, cell, ident):
-        self.cell = cell # cell of origin
-        self.addr = addr # addr of origin
-        self.ident = ident # an identifier for the attribute that will hold the actual data
-        setattr(self, ident, data)
 
+# the above, tabulated by configure() for its UNIVERSE_SIZE since they are needed for every particle
+# that moves between cells. CUBIC_IDX[cell] is cubic_idx(cell) and NEIGHBORHOOD[cell] (FULL_NEIGHBORHOOD[cell])
+# lists neighborhood(cell) (neighborhood(cell, full=True)). HALF_SHELL[cell_r, cell_n] is
+# n3l_cell(cell_r, cell_n), as a numpy array so that it can also be indexed with arrays of cells.
+# n3l_cell() only holds for the cells neighborhood() yields, so that is where it is set
+CUBIC_IDX = None
+NEIGHBORHOOD = None
+FULL_NEIGHBORHOOD = None
+HALF_SHELL = None
+
+# records of particle data while it's passing through pipelines, with the cell and address it came
+# from. Each kind holds its data in a fixed slot: Position.r, Velocity.v and Acceleration.a
+class Particle:
+    __slots__ = ("cell", "addr")
+
+    # the same particle, for records of the same kind
     def __eq__(self, obj):
-        return self.ident == obj.ident and self.cell == obj.cell and self.addr == obj.addr
-    
+        return type(self) is type(obj) and self.cell == obj.cell and self.addr == obj.addr
+
     def __str__(self):
-        return f"{self.origin()}, {getattr(self,self.ident)}"
+        return f"{self.origin()}, {getattr(self, self.__slots__[0])}"
 
     def origin(self):
-        return f"({cubic_idx(self.cell)}, {self.addr})"
+        return f"({CUBIC_IDX[self.cell]}, {self.addr})"
+
+class Position(Particle):
+    __slots__ = ("r",)
+
+    def __init__(self, r, addr, cell):
+        self.cell = cell # cell of origin
+        self.addr = addr # addr of origin
+        self.r = r
+
+class Velocity(Particle):
+    __slots__ = ("v",)
+
+    def __init__(self, v, addr, cell):
+        self.cell = cell
+        self.addr = addr
+        self.v = v
+
+class Acceleration(Particle):
+    __slots__ = ("a",)
 
-Position = lambda r, addr, cell: Struct(r, addr, cell, "r")
-Velocity = lambda v, addr, cell: Struct(v, addr, cell, "v")
-Acceleration = lambda a, addr, cell: Struct(a, addr, cell, "a")
+    def __init__(self, a, addr, cell):
+        self.cell = cell
+        self.addr = addr
+        self.a = a
 
 # given a [x,y,z] position vector, gives the linear cell index of the cell it should be placed in
 cell_from_position = lambda r: linear_idx(*[floor(x/CUTOFF)%UNIVERSE_SIZE for x in r])
@@ -268,6 +350,9 @@ class And(Logic):
             all([i.get() and i.get() is not NULL for i in self.i])
         )
 
+    def has_pending_work(self):
+        return False
+
 class Or(Logic):
     def __init__(self,n,ident):
         super().__init__(ident)
@@ -280,6 +365,9 @@ class Or(Logic):
             any([i.get() and i.get() is not NULL for i in self.i])
         )
 
+    def has_pending_work(self):
+        return False
+
 # Sets list or nested list of Outputs to NULL
 def nul(out):
     if isinstance(out,Output):
@@ -303,13 +391,82 @@ def _lj(reference, neighbor):
     else:
         return 4.0*EPSILON*(6.0*SIGMA**6.0/r**7.0-12.0*SIGMA**12/r**13.0)*(neighbor - reference)/r
 
-# compute LJ force between two particles given their position
-def lj(reference, neighbor):
-    f = _lj(reference, neighbor)
+# compute LJ force between two particles given their position, from table (an LJTable) if given
+def lj(reference, neighbor, table=None):
+    f = _lj(reference, neighbor) if table is None else table.force(reference, neighbor)
     return numpy.minimum(numpy.abs(f), LJ_MAX) * numpy.sign(f)
 
-_lj_max = _lj(numpy.array([0., 0., 0.]), numpy.array([(26/7)**(1/6)*SIGMA, 0., 0.]))[0]
-LJ_MAX = 4*numpy.array([_lj_max, _lj_max, _lj_max])
+# lj() for many pairs at once, see modr_batch(). Returns an (n, 3) array
+def lj_batch(references, neighbors, table=None):
+    if table is not None:
+        f = table.force(references, neighbors)
+        return numpy.minimum(numpy.abs(f), LJ_MAX) * numpy.sign(f)
+    r = norm(modr_batch(references, neighbors), axis=1)
+    coincident = r == 0
+    r = numpy.where(coincident, 1., r)[:, None]
+    f = 4.0*EPSILON*(6.0*SIGMA**6.0/r**7.0-12.0*SIGMA**12/r**13.0)*(neighbors - references)/r
+    f[coincident] = 0.
+    return numpy.minimum(numpy.abs(f), LJ_MAX) * numpy.sign(f)
+
+# the factor _lj() multiplies neighbor - reference by, as a function of r^2
+def lj_factor(r2):
+    return 4.0*EPSILON*(6.0*SIGMA**6.0/r2**4-12.0*SIGMA**12/r2**7)
+
+# LJ forces the way force pipelines evaluate them, without powers of r: lj_factor() is looked up by
+# r^2 and interpolated. r^2 below CUTOFF^2 is split into segments that halve towards 0, segment k
+# covering CUTOFF^2 / 2^(k+1) to CUTOFF^2 / 2^k, and each segment into bins of equal width. A bin
+# holds the coefficients of the polynomial of the given order through lj_factor() at Chebyshev
+# nodes in it, so the table takes segments * bins * (order + 1) words. Pairs at or beyond CUTOFF
+# get no force and r^2 below the last segment gets the force at its start
+class LJTable:
+    def __init__(self, bins, segments, order):
+        if bins < 1 or segments < 1 or order < 0:
+            raise ValueError(f"an LJ table needs bins and segments >= 1 and order >= 0 (got {bins}, {segments}, {order})")
+        self.bins = bins
+        self.segments = segments
+        self.order = order
+        self.top = CUTOFF**2
+        self.bottom = self.top / 2**segments
+
+        nodes = 0.5 - 0.5*numpy.cos(numpy.pi*(2*numpy.arange(order + 1) + 1)/(2*order + 2)) # in [0, 1)
+        start = self.top / 2**(numpy.arange(segments) + 1) # of each segment, which is as long
+        width = start / bins
+        r2 = start[:, None, None] + width[:, None, None] * (numpy.arange(bins)[None, :, None] + nodes)
+        # highest power first, of the position within the bin (0 to 1)
+        self.coefficients = lj_factor(r2) @ numpy.linalg.inv(numpy.vander(nodes)).T
+
+    def __str__(self):
+        return (f"LJ table: {self.segments} segments of {self.bins} bins, order {self.order} "
+                f"({self.coefficients.size} coefficients), error {self.error():.2e} of LJ_MAX")
+
+    # lj_factor() interpolated, for an array of r^2
+    def __call__(self, r2):
+        clipped = numpy.clip(r2, self.bottom, self.top)
+        k = numpy.clip(numpy.ceil(numpy.log2(self.top / clipped)).astype(int) - 1, 0, self.segments - 1)
+        start = self.top / 2.0**(k + 1)
+        x = (clipped - start) / start * self.bins
+        b = numpy.clip(numpy.floor(x).astype(int), 0, self.bins - 1)
+        x = x - b
+        c = self.coefficients[k, b]
+        f = c[..., 0]
+        for j in range(1, self.order + 1):
+            f = f*x + c[..., j]
+        return numpy.where(r2 < self.top, f, 0.)
+
+    # the force on reference, unclamped. Takes the arguments of lj() or lj_batch()
+    def force(self, references, neighbors):
+        d = modr_batch(references, neighbors)
+        return self((d*d).sum(axis=-1))[..., None] * (neighbors - references)
+
+    # the largest difference between the tabulated and the exact force (_lj()) over the separations
+    # the table covers where the force isn't clamped, relative to LJ_MAX
+    def error(self, samples=100000):
+        r2 = numpy.geomspace(self.bottom, self.top, samples, endpoint=False)
+        exact = lj_factor(r2) * numpy.sqrt(r2)
+        unclamped = numpy.abs(exact) <= LJ_MAX[0]
+        return numpy.max(numpy.abs(self(r2) * numpy.sqrt(r2) - exact)[unclamped]) / LJ_MAX[0]
+
+LJ_TABLE = None # the LJTable of --lj-table, see configure()
 
    
 # given the double_buffer signal from control_unit, computes the address offset into the BRAMs for this cycle
@@ -328,11 +485,64 @@ def clear_records():
     os.mkdir(path)
 
 
-# globally accessible FPGA elements
-m = MockFPGA()
-null_const = m.add(NullConst())
-reset_const = m.add(ResetConst())
-
-p_caches, p_imuxes, p_omuxes = init_bram("p", ["phase3","phase1"])
-v_caches, v_imuxes, v_omuxes = init_bram("v", ["phase1","phase3"])
+# Sets the parameters above for config (a system.Config) and seeds random with its seed. A design is
+# built for the Config configured when it is built (see emulator.Emulator). Modules that import
+# everything from here read these as common.N_CELL etc., since the import copies the values of the
+# Config configured at the time
+def configure(config):
+    global CONFIG, args, T, UNIVERSE_SIZE, N_PARTICLE, SEED, N_CPAR, N_PPAR, NSIZE, N_CELL, L, N_IDENT
+    global CUBIC_IDX, NEIGHBORHOOD, FULL_NEIGHBORHOOD, HALF_SHELL, LJ_TABLE
+    CONFIG = config
+    args = config.args()
+    T = args.time
+    UNIVERSE_SIZE = args.size
+    N_PARTICLE = args.particles
+    SEED = args.seed
+    N_CPAR = args.cpar
+    N_PPAR = args.ppar
+    N_CELL = UNIVERSE_SIZE ** 3
+    L = CUTOFF * UNIVERSE_SIZE
+    N_IDENT = N_CELL*BSIZE
+
+    seed(SEED)
+
+    NSIZE = sum([1 for _ in neighborhood(0)])
+    CUBIC_IDX = [cubic_idx(cell) for cell in range(N_CELL)]
+    NEIGHBORHOOD = [list(neighborhood(cell)) for cell in range(N_CELL)]
+    FULL_NEIGHBORHOOD = [list(neighborhood(cell, full=True)) for cell in range(N_CELL)]
+    HALF_SHELL = numpy.zeros((N_CELL, N_CELL), dtype=bool)
+    for cell_r, cells in enumerate(NEIGHBORHOOD):
+        HALF_SHELL[cell_r, cells] = True
+
+    LJ_TABLE = LJTable(args.lj_table, args.lj_segments, args.lj_order) if args.lj_table else None
+
+# the defaults, until a design is built for another Config
+configure(system.Config())
+
+# _lj() needs an L, the separation is well within the default one
+_lj_max = _lj(numpy.array([0., 0., 0.]), numpy.array([(26/7)**(1/6)*SIGMA, 0., 0.]))[0]
+LJ_MAX = 4*numpy.array([_lj_max, _lj_max, _lj_max])
 
+# the MockFPGA (or PartitionedFPGA, see partition.py) a design is built on, for the options args
+def build_fpga(args):
+    if args.workers > 1:
+        m = PartitionedFPGA(args.workers)
+    else:
+        m = MockFPGA(
+            event_driven=args.event_driven or args.fast_forward,
+            backend="codegen" if args.codegen else "interpreter",
+            fast_forward=args.fast_forward,
+            profile=args.profile > 0,
+        )
+    m.report_critical_path = args.critical_path
+    return m
+
+# The elements of m shared by the phases: the position and velocity caches, the muxes each phase
+# accesses them through and the constants wired to the muxes' unused inputs
+class Caches:
+    def __init__(self, m):
+        self.null_const = m.add(NullConst())
+        self.reset_const = m.add(ResetConst())
+
+        self.p_caches, self.p_imuxes, self.p_omuxes = init_bram(m, "p", ["phase3","phase1"])
+        self.v_caches, self.v_imuxes, self.v_omuxes = init_bram(m, "v", ["phase1","phase3"])
@@ -0,0 +1,111 @@
+import json
+
+from hls import *
+from common import *
+import common
+
+'''
+Performance counters of the emulated accelerator, enabled with emulator.py --counters. After every
+clock() the emulator hands the counters the number of cycles it took (more than one if the FPGA
+fast-forwarded) and they sample the state of the units they watch. At the end of each timestep one
+record per phase is appended to counters.jsonl as a line of JSON:
+
+* timestep, phase and cycles, plus the N_PARTICLE, N_CELL, T, N_CPAR, N_PPAR columns of performance.csv
+* force_pipeline_busy/idle, particle_filter_busy/idle: per unit, the cycles it held at least one pair
+  (accepting one or with one in its pipeline) and the cycles it didn't
+* force_pipeline_issued, particle_filter_issued: per unit, the cycles a pair entered its pipeline
+* pair_queue_occupancy, velocity_queue_out_occupancy, velocity_queue_next_occupancy: histograms,
+  summed over the units, of the queue lengths: entry k is the unit-cycles spent with k entries queued
+* dispatches: cycles the position read controller dispatched a batch
+* p_ring_reg_occupied, v_ring_reg_occupied: register-cycles the ring registers held a particle
+  (out of cycles * N_CELL)
+
+Cycles skipped by fast-forwarding are counted with the state sampled after the skip, which for the
+watched units is the state they were in during the skip.
+'''
+
+PHASES = ["phase 1", "phase 3"]
+
+class Counters:
+    def __init__(self, control_unit, phase1, path="counters.jsonl"):
+        self.control_unit = control_unit
+        self.path = path
+        self.force_pipelines = [cp.force_pipeline for cp in phase1.compute_pipelines]
+        self.filters = [f for cp in phase1.compute_pipelines for f in cp.filter_bank]
+        # the Outputs driving their inputs, read directly since this runs every cycle
+        self.force_pipeline_inputs = [unit.i.output for unit in self.force_pipelines]
+        self.filter_inputs = [(unit.reference.output, unit.neighbor.output) for unit in self.filters]
+        self.pair_queues = [cp.pair_queue for cp in phase1.compute_pipelines]
+        self.dispatch = phase1.position_read_controller.dispatch
+        self.v_ring_nodes = getattr(phase1, "v_ring_nodes", [])
+        self.p_ring_regs = getattr(phase1, "p_ring_regs", [])
+        self.v_ring_regs = getattr(phase1, "v_ring_regs", [])
+        self.reset()
+
+    def reset(self):
+        self.records = {phase: {
+            "cycles": 0,
+            "force_pipeline_busy": [0 for _ in self.force_pipelines],
+            "force_pipeline_issued": [0 for _ in self.force_pipelines],
+            "particle_filter_busy": [0 for _ in self.filters],
+            "particle_filter_issued": [0 for _ in self.filters],
+            "pair_queue_occupancy": [],
+            "velocity_queue_out_occupancy": [],
+            "velocity_queue_next_occupancy": [],
+            "dispatches": 0,
+            "p_ring_reg_occupied": 0,
+            "v_ring_reg_occupied": 0,
+        } for phase in PHASES}
+
+    # counts the state after a clock() that advanced n cycles
+    def sample(self, n):
+        record = self.records[PHASES[0] if self.control_unit.phase1_ready.val is True else PHASES[1]]
+        record["cycles"] += n
+
+        busy = record["force_pipeline_busy"]
+        issued = record["force_pipeline_issued"]
+        for k, (unit, i) in enumerate(zip(self.force_pipelines, self.force_pipeline_inputs)):
+            if i.val is not NULL:
+                issued[k] += n
+                busy[k] += n
+            elif unit._n != 0:
+                busy[k] += n
+
+        busy = record["particle_filter_busy"]
+        issued = record["particle_filter_issued"]
+        for k, (unit, (reference, neighbor)) in enumerate(zip(self.filters, self.filter_inputs)):
+            if reference.val is not NULL and neighbor.val is not NULL:
+                issued[k] += n
+                busy[k] += n
+            elif unit._n != 0:
+                busy[k] += n
+
+        histogram(record["pair_queue_occupancy"], [len(unit._queue) for unit in self.pair_queues], n)
+        histogram(record["velocity_queue_out_occupancy"], [len(unit._queue_out) for unit in self.v_ring_nodes], n)
+        histogram(record["velocity_queue_next_occupancy"], [len(unit._queue_next) for unit in self.v_ring_nodes], n)
+
+        if self.dispatch.val is True:
+            record["dispatches"] += n
+        record["p_ring_reg_occupied"] += n * sum([r.contents is not NULL for r in self.p_ring_regs])
+        record["v_ring_reg_occupied"] += n * sum([r.contents is not NULL for r in self.v_ring_regs])
+
+    # appends the records of timestep t to the file and starts counting the next timestep
+    def flush(self, t):
+        with open(self.path, "a") as fp:
+            for phase, record in self.records.items():
+                cycles = record["cycles"]
+                line = {
+                    "N_PARTICLE": common.N_PARTICLE, "N_CELL": common.N_CELL, "T": common.T, "N_CPAR": common.N_CPAR, "N_PPAR": common.N_PPAR,
+                    "timestep": t, "phase": phase, **record,
+                    "force_pipeline_idle": [cycles - b for b in record["force_pipeline_busy"]],
+                    "particle_filter_idle": [cycles - b for b in record["particle_filter_busy"]],
+                }
+                print(json.dumps(line), file=fp)
+        self.reset()
+
+# adds n to the entry of counts for each of the lengths
+def histogram(counts, lengths, n):
+    for length in lengths:
+        while len(counts) <= length:
+            counts.append(0)
+        counts[length] += n
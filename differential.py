@@ -0,0 +1,228 @@
+import argparse
+import hashlib
+import os
+import pickle
+import shlex
+import subprocess
+import sys
+import tempfile
+
+'''
+Differential test of two simulation engines. The same design is built twice, in two processes: a
+reference with the emulator options given and an alternative with --alt added to them, e.g.
+
+    python differential.py -u 3 -n 100 -t 2 --alt "--codegen"
+    python differential.py -u 3 -n 100 -t 2 --alt "--event-driven --fast-forward --phase-gating" --every 10
+
+Both run emulator.py with the same particles, including its verification. They are stopped every
+--every cycles at the same clock_total, and the contents of every Register and BRAM and the
+ControlUnit's timestep and phase are compared. An engine that fast-forwards can only stop after a
+jump, so the other one is then clocked up to the same cycle. The first cycle at which any of them
+differ is reported with the units involved, which exits with status 1. Storage units that only one
+of the designs has (e.g. with --vectorize) are listed and not compared.
+
+Each process writes its output to a log in a temporary directory, which is printed if it fails, and
+neither writes records/ or performance.csv.
+'''
+
+EMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "emulator.py")
+REPORTED = 10 # differing units shown at a divergence
+
+class Stop(Exception):
+    pass
+
+# a plain value standing for val, equal for equal hardware state whichever way it is stored:
+# numpy arrays become lists of floats, objects their class name and attributes
+def canonical(val):
+    from hls import ArrayStorage, fields
+    import numpy
+    if val is None or type(val) in (bool, int, float, str):
+        return val
+    if isinstance(val, numpy.ndarray):
+        return ("array", val.tolist())
+    if isinstance(val, numpy.generic):
+        return val.item()
+    if type(val) is ArrayStorage:
+        return [canonical(val[addr]) for addr in range(len(val))]
+    if type(val) in (list, tuple):
+        return [canonical(x) for x in val]
+    if hasattr(val, "__dict__") or hasattr(val, "__slots__"):
+        return (type(val).__name__, sorted([(k, canonical(x)) for k, x in fields(val).items()]))
+    return repr(val)
+
+def digest(val):
+    return hashlib.blake2b(repr(val).encode(), digest_size=16).digest()
+
+# Builds the emulator with the given options in this process and runs it, stopping after clock() whenever
+# clock_total reaches the cycle the parent asked for. Messages go over the original stdout, the
+# emulator's output goes to log
+def child(options, log):
+    inbox = sys.stdin.buffer
+    outbox = os.fdopen(os.dup(1), "wb")
+    sys.stdout.flush()
+    fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+
+    sys.path.insert(0, os.path.dirname(EMULATOR))
+    import system
+    import emulator
+    from hls import BRAM, Register
+    design = emulator.Emulator(system.parse_config(options), records=False)
+    m = design.m
+
+    def send(obj):
+        pickle.dump(obj, outbox)
+        outbox.flush()
+
+    def storage():
+        return {u.name: canonical(u.contents) for u in m.units if type(u) is Register or type(u) is BRAM}
+
+    target = pickle.load(inbox)
+    def report(done):
+        nonlocal target
+        m.sync()
+        cu = design.control_unit
+        send(("state", m.clock_total, cu.t, cu.phase, done, {name: digest(val) for name, val in storage().items()}))
+        while True:
+            command = pickle.load(inbox)
+            if command is None:
+                raise Stop
+            if type(command) is list:
+                contents = storage()
+                send(("details", {name: contents[name] for name in command}))
+            elif done:
+                send(("state", m.clock_total, cu.t, cu.phase, done, {name: digest(val) for name, val in storage().items()}))
+            else:
+                target = command
+                return
+
+    clock = m.clock
+    def lockstep():
+        clock()
+        if m.clock_total >= target:
+            report(False)
+    m.clock = lockstep
+
+    try:
+        design.report(design.run())
+        report(True)
+    except Stop:
+        pass
+
+class Engine:
+    def __init__(self, label, options, directory):
+        self.label = label
+        self.log = os.path.join(directory, f"{label}.log")
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", self.log] + options,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=directory)
+
+    def send(self, obj):
+        pickle.dump(obj, self.process.stdin)
+        self.process.stdin.flush()
+
+    def recv(self):
+        try:
+            return pickle.load(self.process.stdout)
+        except EOFError:
+            with open(self.log) as fp:
+                lines = fp.read().split("\n")
+            print(f"The {self.label} emulator exited before the comparison was done. The end of its output:")
+            print("\n".join([line for line in lines if not line.startswith("CYCLE")][-20:]))
+            exit(1)
+
+    # clocks until clock_total reaches target, returns (cycle, t, phase, done, digests)
+    def advance(self, target):
+        self.send(target)
+        return self.recv()[1:]
+
+    def stop(self):
+        try:
+            self.send(None)
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+
+# the first address at which two BRAM contents differ, with the values there
+def first_difference(a, b):
+    for addr, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return addr, x, y
+    return len(a), None, None
+
+def short(val, n=160):
+    text = repr(val)
+    return text if len(text) <= n else text[:n] + "..."
+
+def main():
+    parser = argparse.ArgumentParser(usage="python differential.py [emulator options] --alt OPTIONS [--every N]")
+    parser.add_argument("--alt", required=True) # options added to the emulator options for the alternative engine
+    parser.add_argument("--every", type=int, default=1) # compare every N cycles
+    # the alternative's options start with "--", which argparse would take for an option of its own
+    argv = sys.argv[1:]
+    if "--alt" in argv[:-1]:
+        k = argv.index("--alt")
+        argv[k:k + 2] = [f"--alt={argv[k + 1]}"]
+    args, options = parser.parse_known_args(argv)
+    if "--ensemble" in options or "--workers" in options:
+        parser.error("the reference can not use --ensemble or --workers")
+
+    with tempfile.TemporaryDirectory() as directory:
+        ref = Engine("reference", options, directory)
+        alt = Engine("alternative", options + shlex.split(args.alt), directory)
+        engines = [ref, alt]
+        states = [engine.advance(args.every) for engine in engines]
+
+        names = [set(state[4]) for state in states]
+        for engine, only in [(ref, names[0] - names[1]), (alt, names[1] - names[0])]:
+            if len(only):
+                print(f"Not compared, only the {engine.label} has: {', '.join(sorted(only))}")
+
+        while True:
+            # bring the engine that is behind up to the other one's cycle
+            while states[0][0] != states[1][0]:
+                k = 0 if states[0][0] < states[1][0] else 1
+                if states[k][3]:
+                    break
+                states[k] = engines[k].advance(states[1 - k][0])
+
+            (cycle, t, phase, done, digests), (alt_cycle, alt_t, alt_phase, alt_done, alt_digests) = states
+            units = [name for name in digests if name in alt_digests and digests[name] != alt_digests[name]]
+            if cycle != alt_cycle or (t, phase) != (alt_t, alt_phase) or len(units):
+                print(f"First divergence at cycle {min(cycle, alt_cycle)}:")
+                if cycle != alt_cycle:
+                    finished = ref if done else alt
+                    print(f"  the {finished.label} reached timestep {t if done else alt_t} at cycle {min(cycle, alt_cycle)}, "
+                          f"the other engine is at cycle {max(cycle, alt_cycle)}")
+                if (t, phase) != (alt_t, alt_phase):
+                    print(f"  control-unit: reference at timestep {t}, {phase}; alternative at timestep {alt_t}, {alt_phase}")
+                if len(units):
+                    shown = units[:REPORTED]
+                    ref.send(shown)
+                    alt.send(shown)
+                    contents, alt_contents = ref.recv()[1], alt.recv()[1]
+                    for name in shown:
+                        a, b = contents[name], alt_contents[name]
+                        if type(a) is list and type(b) is list and len(a) == len(b):
+                            addr, a, b = first_difference(a, b)
+                            print(f"  {name}[{addr}]: reference {short(a)}; alternative {short(b)}")
+                        else:
+                            print(f"  {name}: reference {short(a)}; alternative {short(b)}")
+                    if len(units) > REPORTED:
+                        print(f"  and {len(units) - REPORTED} more units")
+                for engine in engines:
+                    engine.stop()
+                exit(1)
+
+            if done and alt_done:
+                break
+            states = [engine.advance(cycle + args.every) for engine in engines]
+
+        for engine in engines:
+            engine.stop()
+        print(f"No divergence: both engines reached timestep {t} in {cycle} cycles (compared every {args.every} cycles)")
+
+if len(sys.argv) > 2 and sys.argv[1] == "--child":
+    child(sys.argv[3:], sys.argv[2])
+else:
+    main()
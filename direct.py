@@ -1,11 +1,10 @@
 from common import *
-from verify import compute_timestep
-import verify
+from verify import Verifier
 
 class dummy:
     _double_buffer = 0
 
-verify.CONTROL_UNIT = dummy()
+verifier = Verifier(dummy())
 
 clear_records()
 seed(SEED)
@@ -23,7 +22,7 @@ for t in range(T):
     P = sum([sum(_v) for _v in velocities])/N_PARTICLE
     KE = sum([sum([norm(v)**2/2 for v in _v]) for _v in velocities])/N_PARTICLE
     print(f"Computing timestep {t}, KE={KE}, P={P}")
-    positions, velocities = compute_timestep(positions, velocities)
+    positions, velocities = verifier.compute_timestep(positions, velocities)
     
     with open(f'records/t{t}','wb') as fp:
         for contents in positions:
@@ -1,26 +1,24 @@
+from time import perf_counter
+import sys
+import system
+
 from hls import *
 from common import *
-import sys
 from random import random, seed, shuffle
 from math import floor, inf
+import common
 import hls
+import hashlib
 import numpy
 import os
+import tempfile
 
 import compute_pipeline
-import verify
-from verify import verify_emulator
-
-if "--naive" in sys.argv:
-    import naive as  phase1
-if "--particle-mapping" in sys.argv:
-    import particle_mapping as phase1
-if "--uniform-spread" in sys.argv:
-    import uniform_spread as phase1
-else:
-    import phase1
-
-import phase3RN
+import counters
+from system import write_performance
+from verify import Verifier
+from phase1 import Phase1
+from phase3RN import Phase3
 
 
 
@@ -62,89 +60,226 @@ class ControlUnit(Logic):
         self.phase1_ready.set(self.phase == PHASE1)
         self.phase3_ready.set(self.phase == PHASE3)
 
-control_unit = m.add(ControlUnit())
-verify.CONTROL_UNIT = control_unit
-
-# control_unit inputs need to be buffered in registers to prevent cycles
-#
-# we can equivalently buffer the outputs. The choice is aesthetic
-phase1_done = m.add(Register("phase1-done"))
-phase1_done.contents = False
-phase3_done = m.add(Register("phase3-done"))
-phase3_done.contents = False
-
-
-# control_unit inputs
-connect(phase1_done.o, control_unit.phase1_done)
-connect(phase3_done.o, control_unit.phase3_done)
-
-# register inputs
-connect(phase1.CTL_DONE, phase1_done.i)
-
-phase3_signal = m.add(And(len(phase3RN.CTL_DONE),"phase3-signal"))
-for signal, i in zip(phase3RN.CTL_DONE, phase3_signal.i):
-    connect(signal, i)    
-connect(phase3_signal.o, phase3_done.i)
-
-# phase 1 inputs
-for i in phase1.CTL_DOUBLE_BUFFER:
-    connect(control_unit.double_buffer, i)
-connect(control_unit.phase1_ready, phase1.CTL_READY)
-
-# phase 3 connections
-for i in phase3RN.CTL_DOUBLE_BUFFER:
-    connect(control_unit.double_buffer, i)
-for i in phase3RN.CTL_READY:
-    connect(control_unit.phase3_ready, i)
-
-# p_muxes inputs
-for mux in concat(p_imuxes, p_omuxes):
-    connect(control_unit.phase3_ready, mux.phase3_ready)
-    connect(control_unit.phase1_ready, mux.phase1_ready)
-
-# v_muxes inputs
-for mux in concat(v_imuxes, v_omuxes):
-    connect(control_unit.phase1_ready, mux.phase1_ready)
-    connect(control_unit.phase3_ready, mux.phase3_ready)
-
-# simulation initialization
-clear_records()
-seed(SEED)
-cidx = [0 for _ in range(N_CELL)] # index into contents of each p_cache
-for _ in range(N_PARTICLE):
-        r = r0()
-        idx = cell_from_position(r)
-        p_caches[idx].contents[cidx[idx]] = r
-        v_caches[idx].contents[cidx[idx]] = v0()
-
-        cidx[idx] += 1
-verify_emulator() # initialized the filter_expect and pipeline_expect sets
-
-
-t = 0
-cycles_total = 0
-t0 = control_unit.t
-max_err = -inf
-with numpy.errstate(all="raise"):
-    while control_unit.t < T:
-        print(f"CYCLE {control_unit.t}-{t} ({UNIVERSE_SIZE}, {N_PARTICLE})")
-        CYCLE = t
-        m.clock()
-        t += 1
-        if control_unit.t != t0:
-            err = verify_emulator()
-            if err > max_err:
-                max_err = err
-            t0 = control_unit.t
-            cycles_total += t
-            t = 0
-
-print(f"Emulator took {cycles_total} clock cycles to simulate {T} timesteps")
-
-
-path = f"performance.csv"
-if not os.path.exists(path):
-    with open(path,"w") as fp:
-        print(f"N_PARTICLE,N_CELL,T,N_CPAR,N_PPAR,cycles_total,max_err", file=fp)
-with open(path,"a") as fp:
-    print(f"{N_PARTICLE},{N_CELL},{T},{N_CPAR},{N_PPAR},{cycles_total},{max_err}", file=fp)
+    def state(self):
+        return {**super().state(), "t": self.t, "phase": self.phase}
+
+    # a phase transition that would fire if evaluated again
+    def has_pending_work(self):
+        return bool((self.phase == PHASE1 and self.phase1_done.val) or (self.phase == PHASE3 and self.phase3_done.val))
+
+# seconds one run spent in m.clock() during each phase and in verification, and the cycles it
+# clocked, for performance.csv
+def new_timing():
+    return {PHASE1: 0.0, PHASE3: 0.0, "verify": 0.0, "cycles": 0}
+
+# The design built for config (a system.Config) on m, or on the MockFPGA its options ask for: the
+# caches, the phases and the control unit, wired together. records=False leaves records/ alone
+class Emulator:
+    def __init__(self, config, m=None, records=True):
+        start = perf_counter() # the netlist is built from here until the simulation initialization
+        common.configure(config)
+        self.config = config
+        self.args = args = common.args
+        self.records = records
+        print(common.NSIZE)
+        if common.LJ_TABLE is not None:
+            print(common.LJ_TABLE)
+
+        self.m = m = m if m is not None else build_fpga(args)
+        self.caches = caches = Caches(m)
+        self.phase1 = phase1 = Phase1(m, caches)
+        self.phase3 = phase3 = Phase3(m, caches)
+        self.control_unit = control_unit = m.add(ControlUnit())
+
+        # control_unit inputs need to be buffered in registers to prevent cycles
+        #
+        # we can equivalently buffer the outputs. The choice is aesthetic
+        phase1_done = m.add(Register("phase1-done"))
+        phase1_done.contents = False
+        phase3_done = m.add(Register("phase3-done"))
+        phase3_done.contents = False
+
+
+        # control_unit inputs
+        connect(phase1_done.o, control_unit.phase1_done)
+        connect(phase3_done.o, control_unit.phase3_done)
+
+        # register inputs
+        connect(phase1.CTL_DONE, phase1_done.i)
+
+        phase3_signal = m.add(And(len(phase3.CTL_DONE),"phase3-signal"))
+        connect_many(phase3.CTL_DONE, phase3_signal.i)
+        connect(phase3_signal.o, phase3_done.i)
+
+        # phase 1 inputs
+        connect_many(control_unit.double_buffer, phase1.CTL_DOUBLE_BUFFER)
+        connect(control_unit.phase1_ready, phase1.CTL_READY)
+
+        # phase 3 connections
+        connect_many(control_unit.double_buffer, phase3.CTL_DOUBLE_BUFFER)
+        connect_many(control_unit.phase3_ready, phase3.CTL_READY)
+
+        # p_muxes inputs
+        for mux in concat(caches.p_imuxes, caches.p_omuxes):
+            connect(control_unit.phase3_ready, mux.phase3_ready)
+            connect(control_unit.phase1_ready, mux.phase1_ready)
+
+        # v_muxes inputs
+        for mux in concat(caches.v_imuxes, caches.v_omuxes):
+            connect(control_unit.phase1_ready, mux.phase1_ready)
+            connect(control_unit.phase3_ready, mux.phase3_ready)
+
+        # skip each phase's logic while the other phase runs
+        if args.phase_gating:
+            m.gate(phase1.CTL_GATED, enabled_by=control_unit.phase1_ready)
+            m.gate(phase3.CTL_GATED, enabled_by=control_unit.phase3_ready)
+
+        if len(args.trace):
+            m.trace(args.trace, args.trace_file)
+        self.perf = counters.Counters(control_unit, phase1) if args.counters else None
+        self.verifier = Verifier(control_unit, caches, phase1.compute_pipelines)
+        self.timing = new_timing()
+
+        # validating and scheduling the netlist is part of building it
+        m.prepare()
+        self.start = start
+        self.build = perf_counter() - start
+
+    # places N_PARTICLE particles drawn from seed s in the caches and computes what the first timestep
+    # should produce
+    def initialize(self, s):
+        if self.records:
+            clear_records()
+        seed(s)
+        p_caches, v_caches = self.caches.p_caches, self.caches.v_caches
+        cidx = [0 for _ in range(common.N_CELL)] # index into contents of each p_cache
+        for _ in range(common.N_PARTICLE):
+                r = r0()
+                idx = cell_from_position(r)
+                p_caches[idx].contents[cidx[idx]] = r
+                v_caches[idx].contents[cidx[idx]] = v0()
+
+                cidx[idx] += 1
+        start = perf_counter()
+        self.verifier.verify_emulator() # initialized the filter_expect and pipeline_expect sets
+        self.timing["verify"] += perf_counter() - start
+
+    # clocks the FPGA from the timestep it is at until timestep T, verifying every timestep. Returns
+    # cycles_total and max_err, counted on from the ones given
+    def simulate(self, cycles_total, max_err):
+        global CYCLE
+        m, control_unit, perf, timing = self.m, self.control_unit, self.perf, self.timing
+        t = 0
+        t0 = control_unit.t
+        with numpy.errstate(all="raise"):
+            while control_unit.t < common.T:
+                print(f"CYCLE {control_unit.t}-{t} ({common.UNIVERSE_SIZE}, {common.N_PARTICLE})")
+                CYCLE = t
+                clock_total = m.clock_total
+                start = perf_counter()
+                m.clock()
+                timing[control_unit.phase] += perf_counter() - start # the phase this cycle ended in
+                timing["cycles"] += m.clock_total - clock_total
+                t += m.clock_total - clock_total # more than one cycle if the FPGA fast-forwarded
+                if perf is not None:
+                    perf.sample(m.clock_total - clock_total)
+                if control_unit.t != t0:
+                    if perf is not None:
+                        perf.flush(t0)
+                    start = perf_counter()
+                    m.sync()
+                    err = self.verifier.verify_emulator()
+                    if self.records:
+                        self.verifier.record_positions(control_unit.t)
+                    timing["verify"] += perf_counter() - start
+                    if err > max_err:
+                        max_err = err
+                    t0 = control_unit.t
+                    cycles_total += t
+                    t = 0
+                    if self.args.checkpoint is not None:
+                        m.save(self.args.checkpoint, extra=(cycles_total, max_err, self.verifier.state()))
+        return cycles_total, max_err
+
+    # Simulates SEED, or the --ensemble seeds from SEED on, from the state the netlist was built in.
+    # Returns (seed, cycles_total, max_err, wall, timing) for each of them, see metrics()
+    def run(self):
+        # the units read the parameters of common.py as they are evaluated
+        if common.CONFIG is not self.config:
+            common.configure(self.config)
+        m, args, SEED = self.m, self.args, common.SEED
+        if args.ensemble > 1:
+            # every seed starts from the state the netlist is in now, before any particle is placed
+            fd, snapshot = tempfile.mkstemp(suffix=".pkl")
+            os.close(fd)
+            results = []
+            try:
+                m.save(snapshot)
+                for s in range(SEED, SEED + args.ensemble):
+                    start = perf_counter()
+                    self.timing = new_timing()
+                    if s != SEED:
+                        m.load(snapshot)
+                        self.verifier.reset()
+                    self.initialize(s)
+                    cycles_total, max_err = self.simulate(0, -inf)
+                    results.append((s, cycles_total, max_err, self.build + perf_counter() - start, self.timing))
+                    print(f"Seed {s}: {cycles_total} clock cycles, max_err {max_err}")
+            finally:
+                os.remove(snapshot)
+
+            cycles = numpy.array([r[1] for r in results])
+            errors = numpy.array([r[2] for r in results])
+            print(f"Ensemble of {args.ensemble} seeds ({SEED} to {SEED + args.ensemble - 1}):")
+            print(f"cycles_total mean {cycles.mean()}, std {cycles.std()}, min {cycles.min()}, max {cycles.max()}")
+            print(f"max_err mean {errors.mean()}, std {errors.std()}, min {errors.min()}, max {errors.max()}")
+            return results
+
+        if args.resume is not None:
+            cycles_total, max_err, verify_state = m.load(args.resume)
+            self.verifier.restore(verify_state)
+        else:
+            self.initialize(SEED)
+            cycles_total, max_err = 0, -inf
+        cycles_total, max_err = self.simulate(cycles_total, max_err)
+        print(f"Emulator took {cycles_total} clock cycles to simulate {common.T} timesteps")
+        if m.fast_forward:
+            print(f"{m.cycles_skipped} of them were fast-forwarded")
+        return [(SEED, cycles_total, max_err, perf_counter() - self.start, self.timing)]
+
+    # The performance.csv row of each of the results of run(), as a dict (see system.COLUMNS). Wall
+    # time, the time spent in each part of it and the peak RSS (of this process, not of --workers) are
+    # per run; in an ensemble every seed's row counts the build once. config_hash identifies the options
+    # other than the seed, so runs that should take the same time can be told apart
+    def metrics(self, results):
+        args = self.args
+        options = sorted([(k, v) for k, v in vars(args).items() if k not in ("seed", "ensemble")])
+        config_hash = hashlib.blake2b(repr(options).encode(), digest_size=8).hexdigest()
+        peak_rss = system.peak_rss()
+        return [{
+            "N_PARTICLE": args.particles, "N_CELL": args.size ** 3, "T": args.time, "N_CPAR": args.cpar, "N_PPAR": args.ppar,
+            "cycles_total": cycles_total, "max_err": max_err, "seed": s, "wall_s": wall, "build_s": self.build,
+            "phase1_s": timing[PHASE1], "phase3_s": timing[PHASE3], "verify_s": timing["verify"],
+            "cycles_per_s": rate(timing), "peak_rss_mb": peak_rss, "config_hash": config_hash,
+        } for s, cycles_total, max_err, wall, timing in results]
+
+    # prints the profile (--profile) and where the time of each of the results of run() went
+    def report(self, results):
+        if self.m.profiler is not None:
+            self.m.profiler.report(self.args.profile)
+
+        for s, cycles_total, max_err, wall, timing in results:
+            print(f"{f'Seed {s}: ' if self.args.ensemble > 1 else ''}{wall:.2f}s: {self.build:.2f}s building the netlist, "
+                  f"{timing[PHASE1]:.2f}s in phase 1, {timing[PHASE3]:.2f}s in phase 3, {timing['verify']:.2f}s verifying "
+                  f"({rate(timing):.1f} cycles/s)")
+
+# cycles per second spent in m.clock()
+def rate(timing):
+    clocked = timing[PHASE1] + timing[PHASE3]
+    return timing["cycles"] / clocked if clocked else 0.0
+
+if __name__ == "__main__":
+    emulator = Emulator(system.parse_config(sys.argv[1:]))
+    results = emulator.run()
+    emulator.report(results)
+    write_performance(emulator.metrics(results))
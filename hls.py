@@ -1,85 +1,119 @@
 from abc import ABC, abstractmethod
-from collections import deque
+import atexit
+from collections import Counter, deque
+from fnmatch import fnmatchcase
+import hashlib
+import os
+import pickle
 import re
+import struct
+import tempfile
+
+import numpy
 
 NULL = "NULL"
 RESET = "RESET"
 
 empty_ident = re.compile(".*/empty")
 
+# NULL and RESET are compared by identity, so they have to be unpickled as the same objects
+class Pickler(pickle.Pickler):
+    def persistent_id(self, obj):
+        if obj is NULL or obj is RESET:
+            return obj
+        return None
+
+class Unpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        return NULL if pid == NULL else RESET
+
+# print every port access and evaluation (binds a PrintTracer when the MockFPGA starts, see Tracer)
 CONFIG_VERBOSE = False
-dioi = 0
-di = lambda: "."*dioi
-def debug(*args, **kwargs):
-    if CONFIG_VERBOSE:
-        print(*args,**kwargs)
 
+# part of the key validate_dag() caches its results under. Bump it whenever critical_chain() or
+# evaluation_order() change what they return, so that older entries are not reused
+CACHE_VERSION = 3
+
+# the default MockFPGA.cache_dir, in the user's cache directory
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "hls")
+
+# whether two values driven onto a wire are indistinguishable to the units reading it.
+# objects are compared by identity and plain scalars by value
+scalars = (bool, int, float, str)
+def same(a, b):
+    return a is b or (type(a) is type(b) and type(a) in scalars and a == b)
+
+# Ports and storage units exist once per wire and per register of the netlist, so they keep their
+# attributes in __slots__ rather than a __dict__ each
 class Input:
+    __slots__ = ("parent", "output", "subname")
+
     def __init__(self, parent, name):
-        self.val = None
         self.parent = parent
-        self.name = f"{parent.name}/{name}"
         self.output = None
         self.subname = name
 
-        if isinstance(self.parent, Logic):
-            self.parent._inputs.append(self)
+        # Logic units list their ports, Registers and BRAMs have fixed ones. Checked by type since
+        # isinstance() on the abstract Logic goes through ABCMeta, and this runs for every port
+        if type(parent) is not Register and type(parent) is not BRAM:
+            parent._inputs.append(self)
 
     def __call__(self):
-        global dioi
-        dioi += 1
-        debug(di() + "reading input", self.name)
-        if self.val is None:
-            self.val = self.output() 
-        dioi -= 1
-        assert self.val is not None, f"{self.name} read None from Output {self.output.name}"
-        return self.val
+        val = self.output.val
+        assert val is not None, f"{self.name} read None from Output {self.output.name}"
+        return val
+
+    get = __call__
+
+    # built when asked for rather than stored in every port
+    @property
+    def name(self):
+        return f"{self.parent.name}/{self.subname}"
+
+    # the value currently driven onto this Input (None if its Output has not been evaluated yet)
+    @property
+    def val(self):
+        return self.output.val
     
     def connected(self):
         return self.output is not None
 
-    def reset(self):
-        self.val = None
-
-    def get(self):
-        return self()
-
     def adjacencies(self):
         return [self.output.name, self.name]
 
 class Output:
+    __slots__ = ("val", "parent", "inputs", "subname")
+
     def __init__(self, parent, name):
         self.val = None
         self.parent = parent
-        self.name = f"{parent.name}/{name}"
         self.inputs = []
         self.subname = name
-        if isinstance(self.parent, Logic):
-            self.parent._outputs.append(self)
-            self.parent._pipeline = deque([[NULL for _ in self.parent._outputs] for _ in self.parent._pipeline])
+        if type(parent) is not Register and type(parent) is not BRAM:
+            parent._outputs.append(self)
+            # an Output added after Logic.pipeline() gets its own column
+            if parent._pipeline.depth:
+                parent._pipeline.add(self)
     
     def __call__(self):
-        debug(di() + "reading output", self.name)
-        if self.val is None:
-            self.parent()
-        assert self.val is not None, f"{type(self.parent)} failed to set non-None value for {self.name}. Could be failure to invoke set() on {self.name} or cycle in graph"
+        assert self.val is not None, f"{type(self.parent)} failed to set non-None value for {self.name}. Could be failure to invoke set() on {self.name} or {self.parent.name} missing from the schedule"
         return self.val
 
     def set(self,val):
-        debug("writing", self.name)
         assert self.val is None, f"{self.name} is being set twice"
         self.val = val
 
+    @property
+    def name(self):
+        return f"{self.parent.name}/{self.subname}"
+
     def connected(self):
         return len(self.inputs) != 0
 
-    def reset(self):
-        debug("reset", self.name)
-        self.val = None
-
 class Register:
+    __slots__ = ("name", "contents", "i", "o", "verbose")
+
     def __init__(self, name):
-        self._called = False
         self.name = name
         self.contents = NULL
         self.i = Input(self, f"i")
@@ -90,23 +124,16 @@ class Register:
         i = self.i()
         if i is not NULL:
             if i is RESET:
-                if self.verbose:
-                    print(f"Resetting register {self.name}")
                 i = NULL
             self.contents = i
-        if self.verbose:
-            print(self.name)
-            print(f"\t{self.i.subname}: {self.i.val}")
-            print(f"\t{self.o.subname}: {self.o.val}")
-            print(f"\tcontents: {self.contents}")
-
 
     def __call__(self):
-        if self._called:
-            return self.contents
-        self._called = True
-        
-        self.o.set(self.contents)
+        self.o.val = self.contents
+
+    # Inputs read while evaluating this unit. A Register's output only depends on
+    # last cycle's contents, so it never depends on anything within a cycle
+    def dependencies(self):
+        return []
 
     def identifiers(self):
         return [self.name, self.i.name, self.o.name]
@@ -124,17 +151,79 @@ class Register:
         else:
             return []
 
-    def reset(self):
-        self.i.reset()
-        self.o.reset()
-        self._called = False
+# BRAM contents kept as float rows in numpy blocks of ARRAY_BLOCK addresses and a mask of the
+# addresses holding data, instead of a list of NULL or separate arrays. A block is only allocated
+# while one of its addresses holds data, so a cache takes memory in proportion to how full it is
+# (the caches fill from the start of each half). It is indexed like that list: reading an address
+# without data gives NULL, reading one with data gives a copy of its row, writing NULL clears it.
+# The last row read is handed out again until its address is written, so a BRAM that keeps
+# reading the same address keeps driving the same object (see same())
+ARRAY_BLOCK = 32
+
+class ArrayStorage:
+    def __init__(self, size, width):
+        self.width = width
+        self.blocks = [None for _ in range(-(-size // ARRAY_BLOCK))]
+        self.valid = numpy.zeros(size, dtype=bool)
+        self._addr = None
+        self._row = None
+
+    def __len__(self):
+        return len(self.valid)
+
+    def __getitem__(self, addr):
+        if type(addr) is slice:
+            return [self[a] for a in range(*addr.indices(len(self)))]
+        if not self.valid[addr]:
+            return NULL
+        if addr != self._addr:
+            self._addr = addr
+            block, row = divmod(addr, ARRAY_BLOCK)
+            self._row = self.blocks[block][row].copy()
+        return self._row
+
+    def __setitem__(self, addr, val):
+        if type(addr) is slice:
+            if type(val) is ArrayStorage and addr == slice(None):
+                self.blocks = [None if b is None else b.copy() for b in val.blocks]
+                self.valid = val.valid.copy()
+                self._addr = None
+            else:
+                for a, v in zip(range(*addr.indices(len(self))), val if type(val) is not ArrayStorage else val[addr]):
+                    self[a] = v
+            return
+        if addr == self._addr:
+            self._addr = None
+        block, row = divmod(addr, ARRAY_BLOCK)
+        if val is NULL:
+            if self.valid[addr]:
+                self.valid[addr] = False
+                if not self.valid[block * ARRAY_BLOCK:(block + 1) * ARRAY_BLOCK].any():
+                    self.blocks[block] = None
+        else:
+            if self.blocks[block] is None:
+                self.blocks[block] = numpy.zeros((ARRAY_BLOCK, self.width))
+            self.blocks[block][row] = val
+            self.valid[addr] = True
+
+    # the rows and the mask of addresses start to stop. The mask is a view, the rows are copied out
+    # of their blocks (zero where no block is allocated)
+    def view(self, start, stop):
+        data = numpy.zeros((stop - start, self.width))
+        for block in range(start // ARRAY_BLOCK, -(-stop // ARRAY_BLOCK)):
+            if self.blocks[block] is not None:
+                lo = max(start, block * ARRAY_BLOCK)
+                hi = min(stop, (block + 1) * ARRAY_BLOCK)
+                data[lo - start:hi - start] = self.blocks[block][lo - block * ARRAY_BLOCK:hi - block * ARRAY_BLOCK]
+        return data, self.valid[start:stop]
 
 class BRAM:
-    def __init__(self, size, name):
-        self._called = False
+    __slots__ = ("name", "contents", "i", "iaddr", "o", "oaddr", "verbose")
 
+    # width stores the contents in an ArrayStorage of rows of that many floats
+    def __init__(self, size, name, width=None):
         self.name = name
-        self.contents = [NULL for _ in range(size)]
+        self.contents = [NULL for _ in range(size)] if width is None else ArrayStorage(size, width)
 
         self.i = Input(self, f"i")
         self.iaddr = Input(self, f"iaddr")
@@ -154,22 +243,19 @@ class BRAM:
             self.contents[iaddr] = i
 
     def __call__(self):
-        if self._called == True:
-            return
-        self._called = True
         oaddr = self.oaddr()
         if oaddr is not NULL:
-            self.o.set(self.contents[oaddr])
+            self.o.val = self.contents[oaddr]
         else:
-            self.o.set(NULL)
+            self.o.val = NULL
 
-        if self.verbose:
-            print(f"{self.name}:")
-            print("\tINPUTS")
-            print(f"\t\toaddr: {self.oaddr.val}")
-            print("\tOUTPUTS")
-            print(f"\t\to: {self.o.val}")
+    # i and iaddr are only consumed by write() at the end of the cycle
+    def dependencies(self):
+        return [self.oaddr]
 
+    # contents can be written under an unchanged oaddr, so BRAMs are always read
+    def has_pending_work(self):
+        return True
 
     def identifiers(self):
         return [self.name, self.i.name, self.iaddr.name, self.o.name, self.oaddr.name]
@@ -192,50 +278,92 @@ class BRAM:
                 ret.append(i.name)
         return ret
 
-    def reset(self):
-        self.i.reset()
-        self.o.reset()
-        self.iaddr.reset()
-        self.oaddr.reset()
-        
-        self._called = False
-
-builtin = ["_n","_inputs","_outputs","_abc_impl","_called","_init","_pipeline"]
+# Fixed length shift register between a Logic unit and its Outputs. Each Output has a column of
+# depth slots, the oldest entry is at head, and busy marks the slots holding data (any non-NULL
+# value). Everything is allocated up front, so shifting moves values around without allocating
+class Pipeline:
+    def __init__(self, depth, outputs):
+        self.depth = depth
+        self.ports = [(o, [NULL] * depth) for o in outputs]
+        self.busy = [False] * depth
+        self.head = 0
+
+    def __len__(self):
+        return self.depth
+
+    def add(self, o):
+        self.ports.append((o, [NULL] * self.depth))
+
+    # puts the oldest entry on the Outputs and stores the values they held in its slot. Returns
+    # how much the number of busy slots changed
+    def shift(self):
+        h = self.head
+        busy = False
+        for o, column in self.ports:
+            val = o.val
+            if val is not NULL:
+                busy = True
+            o.val = column[h]
+            column[h] = val
+
+        self.head = h + 1 if h + 1 != self.depth else 0
+        change = busy - self.busy[h]
+        self.busy[h] = busy
+        return change
+
+    # whether the entry stored by the last shift() holds data
+    def last_busy(self):
+        return self.busy[self.head - 1]
+
+    # number of shifts before an entry holding data reaches the Outputs (None if there is none)
+    def distance(self):
+        for k in range(self.depth):
+            if self.busy[(self.head + k) % self.depth]:
+                return k
+        return None
+
+    # shifts k entries that don't hold data through without touching the Outputs
+    def advance(self, k):
+        self.head = (self.head + k) % self.depth
+
+builtin = ["_n","_inputs","_outputs","_abc_impl","_init","_pipeline"]
 
 
 class Logic(ABC):
     def __init__(self, name):
         self._init = True
-        self._called = False
         self._inputs = []
         self._outputs = []
-        self._pipeline = deque([]) 
+        self._pipeline = Pipeline(0, [])
         self.name = name
         self.verbose = False
         self.debug = False
         self.empty = Output(self,"empty")
         self._n = 0 # number of inputs in pipeline
 
-    def __setattr__(self, k, v):
-        if k != "_init" and not hasattr(self,"_init"):
-            raise Exception("Must call super().__init__() on hls.Logic before setting any attributes")
-
-        super(Logic, self).__setattr__(k, v)
-
     @abstractmethod
     def logic(self):
         pass
 
     def pipeline(self, n):
-        self._pipeline = deque([[NULL for _ in self._outputs] for _ in range(n)])
+        self._pipeline = Pipeline(n, [o for o in self._outputs if o is not self.empty])
+
+    # The attributes MockFPGA.save() stores for this unit: everything starting with "_" (what verbose
+    # prints as STATE) except the engine's own. Units keeping state in other attributes add them
+    def state(self):
+        return {k: v for k, v in vars(self).items() if k[0] == "_" and k not in builtin}
+
+    # Whether logic() could drive different outputs (or change its own state) if it were evaluated
+    # again with the same inputs as last time, e.g. because a queue still has entries to hand out.
+    # MockFPGA(event_driven=True) skips units whose inputs have not changed unless this is True or
+    # their pipeline still has to drain. The default is the safe answer: units that are a pure
+    # function of their inputs (or whose state only moves when an input changes) should override it
+    def has_pending_work(self):
+        return True
  
     def __call__(self):
-        if self._called == True:
-            return
-        self._called = True
-        debug(di() + f"Evaluating {self.name}")
-        if self.debug:
-            breakpoint()
+        for o in self._outputs:
+            o.val = None
         self.logic()
         self.empty.set(NULL)
 
@@ -248,44 +376,15 @@ class Logic(ABC):
                 print(f"ERROR: Must set all Outputs to non-None in {self.name}.logic()")
                 exit(1)
 
-        self._pipeline.append(
-                [o.val for o in self._outputs]
-        )
-
-        if any([o.val is not NULL for o in self._outputs]):
-            self._n += 1
-
-        for o, val in zip(self._outputs, self._pipeline.popleft()):
-            o.val = val
- 
-        if any([o.val is not NULL for o in self._outputs]):
-            self._n -= 1
+        if self._pipeline.depth:
+            change = self._pipeline.shift()
+            if change:
+                self._n += change
  
         self.empty.val = self._n == 0
 
-        if self.verbose:
-            print(f"{self.name}:")
-            print("\tSTATE")
-            for attr in dir(self):
-                if attr[0] == "_" and attr[1] != "_" and attr not in builtin:
-                    print(f"\t\t{attr}: {getattr(self,attr)}")
-            print("\tINPUTS")
-            for i in self._inputs:
-                print(f"\t\t{i.name.split('/')[1]}: {i.val}")
-            print("\tOUTPUTS")
-            for o in self._outputs:
-                print(f"\t\t{o.name.split('/')[1]}: {o.val}")
-
-
-    def reset(self):
-        debug("reset", self.name)
-        for i in self._inputs:
-            i.reset()
-
-        for o in self._outputs:
-            o.reset()
-
-        self._called = False
+    def dependencies(self):
+        return self._inputs
 
     def identifiers(self):
         return [self.name] + [i.name for i in self._inputs] + [o.name for o in self._outputs]
@@ -300,40 +399,728 @@ class Logic(ABC):
                 ret.append(i.name)
         return ret
 
-class MockFPGA:
+# Evaluates a Logic unit only while its enable signal is True. The first cycle the signal drops the
+# unit is still evaluated so it can see it has been disabled (and clear its state), and it keeps
+# being evaluated until its pipeline has drained. After that its outputs are driven NULL once and
+# the unit is skipped until it is enabled again
+class Gate:
+    def __init__(self, unit, signal, evaluate=None):
+        self.unit = unit
+        self.signal = signal
+        self.state = 0 # 0: enabled, 1: evaluated since it was disabled, 2: outputs held at NULL
+        # what evaluates the unit (through the Tracer, see MockFPGA.evaluator)
+        self.evaluate = evaluate or unit
+
+    def __call__(self):
+        unit = self.unit
+        if self.signal.val is True:
+            self.state = 0
+            self.evaluate()
+        elif self.state == 0 or unit._n != 0:
+            self.state = 1
+            self.evaluate()
+        elif self.state == 1:
+            self.state = 2
+            for o in unit._outputs:
+                o.val = NULL
+
+# n Inputs of one unit that are read together, one per replica of a LogicArray. Each element is
+# an ordinary Input and is connected to an ordinary Output with connect()
+class InputArray:
+    def __init__(self, parent, name, n):
+        self.inputs = [Input(parent, f"{name}-{k}") for k in range(n)]
+
+    def __getitem__(self, k):
+        return self.inputs[k]
+
+    def __len__(self):
+        return len(self.inputs)
+
+    # reads the driving Outputs directly: the schedule has evaluated them all by now
+    def get(self):
+        return [i.output.val for i in self.inputs]
+
+    # get() as a numpy object array, for selecting replicas with boolean masks
+    def array(self):
+        return numpy.fromiter([i.output.val for i in self.inputs], dtype=object, count=len(self.inputs))
+
+# n Outputs of one unit that are set together, one per replica of a LogicArray
+class OutputArray:
+    def __init__(self, parent, name, n):
+        self.outputs = [Output(parent, f"{name}-{k}") for k in range(n)]
+
+    def __getitem__(self, k):
+        return self.outputs[k]
+
+    def __len__(self):
+        return len(self.outputs)
+
+    # Sets every Output to its element of vals. The values are stored directly, after one check that
+    # none was set already. A MockFPGA whose Tracer or profiler has to see each write binds
+    # set_each() in its place on the array, and codegen binds set_unchecked() (see MockFPGA.bind_ports)
+    def set(self, vals):
+        assert [o.val for o in self.outputs].count(None) == len(self.outputs), f"{self.outputs[0].parent.name} sets {self.outputs[0].subname} twice"
+        for o, val in zip(self.outputs, vals):
+            o.val = val
+
+    def set_each(self, vals):
+        for o, val in zip(self.outputs, vals):
+            o.set(val)
+
+    def set_unchecked(self, vals):
+        for o, val in zip(self.outputs, vals):
+            o.val = val
+
+# n copies of the same logic evaluated as a single unit. Its ports are InputArrays and OutputArrays
+# with one element per replica, and logic() computes every replica at once (over numpy arrays where
+# that helps). replica(k) gives a view with the scalar ports of replica k, so an array can be
+# wired up exactly like a list of the scalar units it replaces
+class LogicArray(Logic):
+    def __init__(self, name, n):
+        super().__init__(name)
+        self.n = n
+
+    def replica(self, k):
+        return Replica(self, k)
+
+class Replica:
+    def __init__(self, array, k):
+        self.array = array
+        self.k = k
+
+    def __getattr__(self, name):
+        port = getattr(self.array, name)
+        if type(port) is InputArray or type(port) is OutputArray:
+            return port[self.k]
+        return port
+
+# Receives the evaluations, port accesses and storage writes of the MockFPGA it is bound to (see
+# MockFPGA.bind_tracer). Each hook is handed the untraced method and has to call it. This one
+# implements the per-unit debug and verbose flags. Without a tracer bound none of this runs: the
+# port and evaluation methods don't format, count or check anything for tracing
+class Tracer:
+    # evaluate(unit) evaluates a Logic unit or reads a BRAM
+    def evaluate(self, unit, evaluate):
+        if getattr(unit, "debug", False):
+            breakpoint()
+        evaluate(unit)
+        if unit.verbose:
+            print(f"{unit.name}:")
+            if isinstance(unit, Logic):
+                print("\tSTATE")
+                for attr in dir(unit):
+                    if attr[0] == "_" and attr[1] != "_" and attr not in builtin:
+                        print(f"\t\t{attr}: {getattr(unit,attr)}")
+            print("\tINPUTS")
+            for i in unit._inputs if isinstance(unit, Logic) else [unit.oaddr]:
+                print(f"\t\t{i.name.split('/')[1]}: {i.val}")
+            print("\tOUTPUTS")
+            for o in unit._outputs if isinstance(unit, Logic) else [unit.o]:
+                print(f"\t\t{o.name.split('/')[1]}: {o.val}")
+
+    # write(unit) writes a Register or BRAM at the end of the cycle
+    def write(self, unit, write):
+        verbose = unit.verbose and type(unit) is Register
+        if verbose and unit.i.val is RESET:
+            print(f"Resetting register {unit.name}")
+        write(unit)
+        if verbose:
+            print(unit.name)
+            print(f"\t{unit.i.subname}: {unit.i.val}")
+            print(f"\t{unit.o.subname}: {unit.o.val}")
+            print(f"\tcontents: {unit.contents}")
+
+    # read(port) reads an Input or Output
+    def read(self, port, read):
+        return read(port)
+
+    # set(o, val) sets an Output
+    def set(self, o, val, set):
+        set(o, val)
+
+# Tracer that also prints every evaluation and port access (what CONFIG_VERBOSE turns on), indented
+# by how deeply they are nested
+class PrintTracer(Tracer):
     def __init__(self):
+        self.depth = 0
+
+    def evaluate(self, unit, evaluate):
+        print("." * self.depth + f"Evaluating {unit.name}")
+        self.depth += 1
+        super().evaluate(unit, evaluate)
+        self.depth -= 1
+
+    def read(self, port, read):
+        print("." * self.depth + f"reading {'input' if isinstance(port, Input) else 'output'} {port.name}")
+        return read(port)
+
+    def set(self, o, val, set):
+        print("." * self.depth + f"writing {o.name}")
+        set(o, val)
+
+# Input.get() and Output.set() without their checks, for backends that only evaluate a unit once
+# every Output it reads has been driven (see codegen.compile_step and MockFPGA.bind_ports)
+def read_unchecked(i):
+    return i.output.val
+
+def set_unchecked(o, val):
+    o.val = val
+
+# Binary record of the values on a set of Outputs. After every cycle the Outputs whose value changed
+# (see same()) are appended to a buffer, which is written to the file in large blocks (and when the
+# process exits). The file is TRACE_MAGIC, the number of Outputs and their names, then one block per
+# cycle with changes: the cycle number, the number of changes and, for each change, the index of the
+# Output and its value (see encode()). export_vcd() converts a trace for waveform viewers
+TRACE_MAGIC = b"HLSTRACE1\n"
+TRACE_BUFFER = 1 << 20
+T_NULL, T_RESET, T_NONE, T_FALSE, T_TRUE, T_INT, T_FLOAT, T_TEXT, T_ARRAY, T_LIST, T_OBJECT = range(11)
+
+class Trace:
+    def __init__(self, path, outputs):
+        self.outputs = outputs
+        self.last = [None for _ in outputs]
+        self.buffer = bytearray(TRACE_MAGIC + struct.pack("<I", len(outputs)))
+        for o in outputs:
+            self.buffer += text(o.name)
+        self.fp = open(path, "wb")
+        atexit.register(self.close)
+
+    def sample(self, cycle):
+        last = self.last
+        changes = []
+        for k, o in enumerate(self.outputs):
+            val = o.val
+            old = last[k]
+            if val is old or (type(val) is type(old) and type(val) in scalars and val == old):
+                continue
+            last[k] = val
+            changes.append(k)
+        if len(changes) == 0:
+            return
+
+        buffer = self.buffer
+        buffer += struct.pack("<QI", cycle, len(changes))
+        for k in changes:
+            buffer += struct.pack("<I", k)
+            encode(last[k], buffer)
+        if len(buffer) > TRACE_BUFFER:
+            self.flush()
+
+    def flush(self):
+        self.fp.write(self.buffer)
+        self.buffer.clear()
+
+    def close(self):
+        if not self.fp.closed:
+            self.flush()
+            self.fp.close()
+
+def text(s):
+    s = s.encode()
+    return struct.pack("<H", len(s)) + s
+
+# Appends val to buffer as a kind byte followed by what that kind needs. numpy arrays are stored as
+# their values, lists and tuples element by element, and other objects as their class name and
+# attributes (one level deep), so nothing is formatted while tracing
+def encode(val, buffer, depth=0):
+    if val is NULL:
+        buffer.append(T_NULL)
+    elif val is RESET:
+        buffer.append(T_RESET)
+    elif val is None:
+        buffer.append(T_NONE)
+    elif type(val) is bool or type(val) is numpy.bool_:
+        buffer.append(T_TRUE if val else T_FALSE)
+    elif isinstance(val, (int, numpy.integer)) and -(1 << 63) <= val < (1 << 63):
+        buffer += struct.pack("<Bq", T_INT, val)
+    elif isinstance(val, (float, numpy.floating)):
+        buffer += struct.pack("<Bd", T_FLOAT, val)
+    elif type(val) is str:
+        buffer.append(T_TEXT)
+        buffer += text(val[:1000])
+    elif type(val) is numpy.ndarray and val.dtype.kind in "biuf":
+        values = val.astype(float, copy=False).ravel()
+        buffer += struct.pack("<BI", T_ARRAY, len(values))
+        buffer += values.tobytes()
+    elif (type(val) is list or type(val) is tuple) and depth < 2:
+        buffer += struct.pack("<BI", T_LIST, len(val))
+        for x in val:
+            encode(x, buffer, depth + 1)
+    elif (hasattr(val, "__dict__") or hasattr(val, "__slots__")) and depth < 2:
+        attributes = fields(val)
+        buffer += struct.pack("<B", T_OBJECT)
+        buffer += text(type(val).__name__)
+        buffer += struct.pack("<I", len(attributes))
+        for k, x in attributes.items():
+            buffer += text(k)
+            encode(x, buffer, depth + 1)
+    else:
+        buffer.append(T_TEXT)
+        buffer += text(type(val).__name__)
+
+# an object's attributes, from its __dict__ or the __slots__ of its classes that it has set
+def fields(val):
+    if hasattr(val, "__dict__"):
+        return vars(val)
+    return {k: getattr(val, k) for cls in type(val).__mro__ for k in getattr(cls, "__slots__", ()) if hasattr(val, k)}
+
+# Reads a trace written by Trace. Returns the Output names and an iterator over (cycle, changes),
+# where changes is a list of (index, kind, value). Values are decoded into numpy arrays, lists of
+# (kind, value), (class name, {attribute: (kind, value)}) for objects, ints, floats and strings.
+# NULL, RESET, None and the bools are only told apart by their kind (their value is None)
+def read_trace(path):
+    fp = open(path, "rb")
+    def read(fmt):
+        return struct.unpack(fmt, fp.read(struct.calcsize(fmt)))
+    def string():
+        length, = read("<H")
+        return fp.read(length).decode()
+    def decode(kind):
+        if kind == T_INT:
+            return read("<q")[0]
+        if kind == T_FLOAT:
+            return read("<d")[0]
+        if kind == T_TEXT:
+            return string()
+        if kind == T_ARRAY:
+            n, = read("<I")
+            return numpy.frombuffer(fp.read(8 * n))
+        if kind == T_LIST:
+            n, = read("<I")
+            return [element() for _ in range(n)]
+        if kind == T_OBJECT:
+            name = string()
+            n, = read("<I")
+            attributes = {}
+            for _ in range(n):
+                k = string()
+                attributes[k] = element()
+            return name, attributes
+        return None
+    def element():
+        kind, = read("<B")
+        return kind, decode(kind)
+
+    if fp.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+        raise ValueError(f"{path} is not a trace written by hls.Trace")
+    n, = read("<I")
+    names = [string() for _ in range(n)]
+
+    def cycles():
+        with fp:
+            while len(header := fp.read(12)) == 12:
+                cycle, count = struct.unpack("<QI", header)
+                changes = []
+                for _ in range(count):
+                    k, kind = read("<IB")
+                    changes.append((k, kind, decode(kind)))
+                yield cycle, changes
+    return names, cycles()
+
+# text for a decoded trace value
+def render(kind, val):
+    if kind in (T_NULL, T_RESET, T_NONE, T_FALSE, T_TRUE):
+        return [NULL, RESET, "None", "False", "True"][kind]
+    if kind == T_ARRAY:
+        return "[" + ",".join([f"{x:g}" for x in val]) + "]"
+    if kind == T_LIST:
+        return "[" + ",".join([render(k, x) for k, x in val]) + "]"
+    if kind == T_OBJECT:
+        name, attributes = val
+        return name + "(" + ",".join([f"{k}={render(*x)}" for k, x in attributes.items()]) + ")"
+    return str(val)
+
+# Converts a trace to a VCD file, one module per unit and one time unit per cycle. Outputs that only
+# carry bools become 1 bit wires and Outputs that only carry ints become 64 bit integers, with NULL as
+# z and RESET or None as x. Anything else becomes a string variable (a GTKWave extension)
+def export_vcd(trace_path, vcd_path):
+    names, cycles = read_trace(trace_path)
+    kinds = [set() for _ in names]
+    for _, changes in cycles:
+        for k, kind, _ in changes:
+            kinds[k].add(kind)
+
+    bits = set([T_NULL, T_RESET, T_NONE, T_FALSE, T_TRUE])
+    types = []
+    for seen in kinds:
+        if seen <= bits:
+            types.append("wire")
+        elif seen <= bits | set([T_INT]):
+            types.append("integer")
+        else:
+            types.append("string")
+
+    def code(k):
+        s = ""
+        while True:
+            s += chr(33 + k % 94)
+            k //= 94
+            if k == 0:
+                return s
+    codes = [code(k) for k in range(len(names))]
+
+    def value(k, kind, val):
+        t = types[k]
+        if t == "string":
+            return f"s{render(kind, val).replace(' ', '_')} {codes[k]}"
+        bit = {T_NULL: "z", T_RESET: "x", T_NONE: "x", T_FALSE: "0", T_TRUE: "1"}.get(kind)
+        if t == "wire":
+            return f"{bit}{codes[k]}"
+        if bit is None:
+            bit = format(val & ((1 << 64) - 1), "b")
+        return f"b{bit} {codes[k]}"
+
+    units = {}
+    for k, name in enumerate(names):
+        unit, _, port = name.rpartition("/")
+        units.setdefault(unit, []).append((k, port))
+
+    _, cycles = read_trace(trace_path)
+    with open(vcd_path, "w") as fp:
+        print("$version hls trace $end", file=fp)
+        print("$timescale 1ns $end", file=fp)
+        print("$scope module fpga $end", file=fp)
+        for unit, ports in units.items():
+            print(f"$scope module {unit} $end", file=fp)
+            for k, port in ports:
+                width = 1 if types[k] == "wire" else 64
+                print(f"$var {types[k]} {width} {codes[k]} {port} $end", file=fp)
+            print("$upscope $end", file=fp)
+        print("$upscope $end", file=fp)
+        print("$enddefinitions $end", file=fp)
+        for cycle, changes in cycles:
+            print(f"#{cycle}", file=fp)
+            for change in changes:
+                print(value(*change), file=fp)
+
+class MockFPGA:
+    def __init__(self, event_driven=False, backend="interpreter", fast_forward=False, profile=False, tracer=None):
+        if backend not in ("interpreter", "codegen"):
+            raise ValueError(f"unknown backend {backend}")
+        if backend == "codegen" and event_driven:
+            raise ValueError("the codegen backend does not support event driven evaluation")
+        if fast_forward and not event_driven:
+            raise ValueError("fast_forward requires event_driven")
         self.units = []
         self._init = False
 
-        self.clock_total = 0
+        # evaluation order computed once by validate(), and the units that are written at the end of each cycle
+        self._schedule = []
+        self._storage = []
 
-    def add(self, obj):
+        # signal (an Output) that enables each gated Logic unit, by id(unit). See Gate
+        self._gates = {}
+        # what clock() calls for each unit of the schedule (the unit itself or its Gate) and for each
+        # Register and BRAM at the end of the cycle (see evaluator() and writer())
+        self._steps = []
+        self._writers = []
+
+        # only re-evaluate units whose inputs changed or that report pending work (see Logic.has_pending_work)
+        self.event_driven = event_driven
+        # skip over cycles in which only pipelines shift NULL entries along (see evaluate_events)
+        self.fast_forward = fast_forward
+
+        # "codegen" evaluates each cycle with a step() generated from the schedule (see codegen.py).
+        # The generated module is also written to codegen_path if that is set before the first clock()
+        self.backend = backend
+        self.codegen_path = None
+        self._step = None
+
+        # time each unit's evaluation (see profiler.py). The Profiler is set up by schedule()
+        self.profile = profile
+        self.profiler = None
+
+        # records the traced Outputs after every cycle (see trace())
+        self.waveform = None
+
+        # Tracer bound when the FPGA starts. Without one, a PrintTracer is bound if CONFIG_VERBOSE is
+        # set and a plain Tracer if any unit has verbose or debug set, otherwise tracing is unbound
+        self.tracer = tracer
+        self._tracer = None
+
+        self.clock_total = 0
+        self.cycles_skipped = 0 # the part of clock_total fast_forward advanced past (see skip_idle)
+
+        # validate_dag() results (critical path and evaluation order) are kept here by netlist_hash(),
+        # so a design is only checked and ordered once. None turns the cache off
+        self.cache_dir = CACHE_DIR
+        # the Logic and BRAM units on the longest combinational chain, set by validate_dag() and
+        # printed if report_critical_path is set
+        self.critical_path = None
+        self.report_critical_path = False
+        self._order = None
+
+    def add(self, obj, enabled_by=None):
         t = type(obj)
         if not isinstance(obj, Logic) and t is not Register and t is not BRAM:
             raise TypeError(f"MockFPGA units must be either Logic, Register, or BRAM (got {t})")
+        if t is not Register and t is not BRAM and "_init" not in obj.__dict__:
+            raise Exception(f"Must call super().__init__() on hls.Logic in {t.__name__}")
         self.units.append(
                 obj
         )
+        self._init = False
+        if enabled_by is not None:
+            self.gate([obj], enabled_by)
         return self.units[-1]
+
+    # Only evaluate units while enabled_by (an Output) is True, e.g. control_unit.phase1_ready.
+    # While disabled their outputs read NULL, so only gate units whose outputs are ignored
+    # (or NULL anyway) whenever the signal is low
+    def gate(self, units, enabled_by):
+        if not isinstance(enabled_by, Output):
+            raise TypeError(f"Gate signal is not type Output() (got {type(enabled_by)})")
+        for unit in units:
+            if not isinstance(unit, Logic):
+                raise TypeError(f"Only Logic units can be gated (got {type(unit)})")
+            self._gates[id(unit)] = enabled_by
+        self._init = False
     
                  
-    def clock(self):
+    # validates and schedules the units the first time they are needed
+    def prepare(self):
         if not self._init:
+            self.bind_tracer()
             if not self.validate():
                 print("Validation of FPGA failed")
                 exit(1) 
-
+            self._init = True
+
+    # Picks the Tracer that schedule() routes this FPGA's evaluations, writes and port accesses through
+    def bind_tracer(self):
+        t = self.tracer
+        if t is None and CONFIG_VERBOSE:
+            t = PrintTracer()
+        elif t is None and any([unit.verbose or getattr(unit, "debug", False) for unit in self.units]):
+            t = Tracer()
+        self._tracer = t
+
+    # what evaluates unit in a step (Registers are read directly, they have no Tracer hook)
+    def evaluator(self, unit):
+        t = self._tracer
+        if t is None or type(unit) is Register:
+            return unit
+        evaluate = type(unit).__call__
+        return lambda: t.evaluate(unit, evaluate)
+
+    # what writes the Register or BRAM unit at the end of the cycle
+    def writer(self, unit):
+        t = self._tracer
+        if t is None:
+            return unit.write
+        write = type(unit).write
+        return lambda: t.write(unit, write)
+
+    # The Tracer, the unchecked ports of codegen and the profiler's timers replace the port methods
+    # logic() calls. Ports have no __dict__ to bind them on, so the Inputs and Outputs of this FPGA's
+    # Logic units get a subclass of Input and Output with those methods (or the plain classes again
+    # if nothing is replaced), and its OutputArrays the set() that matches. Other MockFPGAs keep theirs
+    def bind_ports(self):
+        inputs = {}
+        outputs = {}
+        t = self._tracer
+        if t is not None:
+            read_input = Input.__call__
+            inputs["__call__"] = inputs["get"] = lambda i: t.read(i, read_input)
+            read_output = Output.__call__
+            outputs["__call__"] = lambda o: t.read(o, read_output)
+            set_output = Output.set
+            outputs["set"] = lambda o, val: t.set(o, val, set_output)
+        elif self.backend == "codegen":
+            inputs["get"] = read_unchecked
+            outputs["set"] = set_unchecked
+        if self.profiler is not None:
+            inputs["get"] = self.profiler.port(inputs.get("get", Input.get))
+            outputs["set"] = self.profiler.port(outputs.get("set", Output.set))
+
+        input_class = type("Input", (Input,), dict(inputs, __slots__=())) if len(inputs) else Input
+        output_class = type("Output", (Output,), dict(outputs, __slots__=())) if len(outputs) else Output
+        set_array = outputs.get("set")
         for unit in self.units:
-            unit()
+            if not isinstance(unit, Logic):
+                continue
+            for i in unit._inputs:
+                i.__class__ = input_class
+            for o in unit._outputs:
+                o.__class__ = output_class
+            for array in vars(unit).values():
+                if type(array) is not OutputArray:
+                    continue
+                if set_array is None:
+                    vars(array).pop("set", None)
+                else:
+                    array.set = array.set_unchecked if set_array is set_unchecked else array.set_each
+
+    def clock(self):
+        self.prepare()
 
+        if self._step is not None:
+            self._step()
+        elif self.event_driven:
+            self.evaluate_events()
+        else:
+            for step in self._steps:
+                step()
+
+            for write in self._writers:
+                write()
+
+        if self.waveform is not None:
+            self.waveform.sample(self.clock_total)
+        self.clock_total += 1
+
+    # Records the Outputs whose names match any of the glob patterns (e.g. "p-ring-node-*/done-batch")
+    # to path after every cycle, see Trace. Only the units added so far are traced
+    def trace(self, patterns, path):
+        outputs = []
         for unit in self.units:
-            if type(unit) is BRAM or type(unit) is Register:
-                unit.write()
-        
+            for o in [unit.o] if type(unit) is Register or type(unit) is BRAM else unit._outputs:
+                if any([fnmatchcase(o.name, pattern) for pattern in patterns]):
+                    outputs.append(o)
+        if len(outputs) == 0:
+            raise ValueError(f"no Output matches {', '.join(patterns)}")
+        self.waveform = Trace(path, outputs)
+        return self.waveform
+
+    # Brings state that is evaluated outside of this object back into it before it is inspected
+    # (see partition.PartitionedFPGA). Everything already lives here for a MockFPGA
+    def sync(self):
+        pass
+
+    # Writes the state of every unit (Register and BRAM contents, Logic.state(), pipeline contents and
+    # the values on the Outputs), the gate states and clock_total to path, along with extra (anything
+    # picklable the caller needs to resume, e.g. its own counters). The file is replaced atomically,
+    # so an interrupted save leaves the previous checkpoint intact
+    def save(self, path, extra=None):
+        self.prepare()
+        self.sync()
+        units = []
         for unit in self.units:
-            unit.reset()
+            if type(unit) is Register or type(unit) is BRAM:
+                units.append((unit.contents, unit.o.val))
+                continue
+            pipeline = unit._pipeline
+            units.append((
+                unit.state(),
+                unit._n,
+                [column for _, column in pipeline.ports],
+                pipeline.busy,
+                pipeline.head,
+                [o.val for o in unit._outputs],
+            ))
+        checkpoint = {
+            "names": [unit.name for unit in self.units],
+            "units": units,
+            "gates": [step.state for step in self._steps if type(step) is Gate],
+            "clock_total": self.clock_total,
+            "extra": extra,
+        }
+        with open(path + ".tmp", "wb") as fp:
+            Pickler(fp, pickle.HIGHEST_PROTOCOL).dump(checkpoint)
+        os.replace(path + ".tmp", path)
+
+    # Restores a checkpoint written by save() and returns its extra. The MockFPGA has to be built the
+    # same way as the one that saved it, since units are matched by their position in self.units.
+    # Contents, pipelines and Outputs are overwritten in place, so references to them (like the ones
+    # the codegen backend binds) stay valid
+    def load(self, path):
+        with open(path, "rb") as fp:
+            checkpoint = Unpickler(fp).load()
+        if checkpoint["names"] != [unit.name for unit in self.units]:
+            raise ValueError(f"{path} was saved from a different netlist")
+        self.prepare()
+
+        for unit, state in zip(self.units, checkpoint["units"]):
+            if type(unit) is Register:
+                unit.contents, unit.o.val = state
+                continue
+            if type(unit) is BRAM:
+                contents, unit.o.val = state
+                unit.contents[:] = contents
+                continue
+            attributes, unit._n, columns, busy, head, vals = state
+            for k, v in attributes.items():
+                setattr(unit, k, v)
+            pipeline = unit._pipeline
+            for (_, column), saved in zip(pipeline.ports, columns):
+                column[:] = saved
+            pipeline.busy[:] = busy
+            pipeline.head = head
+            for o, val in zip(unit._outputs, vals):
+                o.val = val
+
+        for gate, state in zip([step for step in self._steps if type(step) is Gate], checkpoint["gates"]):
+            gate.state = state
+        if self.event_driven:
+            self._dirty[:] = [True for _ in self._dirty]
+        self.clock_total = checkpoint["clock_total"]
+        return checkpoint["extra"]
+
+    # One cycle of event driven simulation. Units that are skipped keep driving the values from the
+    # last time they were evaluated, which is what they would have driven again anyway.
+    #
+    # The cycle is idle if no Output, Register or BRAM changed and the only units evaluated were
+    # pipelines with unchanged inputs and no pending work that pushed and popped NULL. The following
+    # cycles then repeat it exactly until one of those pipelines pops a non-NULL entry, so with
+    # fast_forward they are skipped in one go (see skip_idle)
+    def evaluate_events(self):
+        dirty = self._dirty
+        idle = self.fast_forward
+
+        for unit in self._registers:
+            unit()
 
-        self.clock_total += 1
+        for k, (unit, step, outputs, fanouts, pipelined) in enumerate(self._events):
+            if not dirty[k] and not unit.has_pending_work():
+                if pipelined is None or (unit._n == 0 and all([o.val is NULL for o in pipelined])):
+                    continue
+                draining = True
+            else:
+                draining = False
+                if idle and type(unit) is not BRAM:
+                    idle = False
+            dirty[k] = False
+
+            old = [o.val for o in outputs]
+            step()
+            for o, val, fanout in zip(outputs, old, fanouts):
+                if not same(o.val, val):
+                    idle = False
+                    for c in fanout:
+                        dirty[c] = True
+
+            if idle and draining:
+                if unit._pipeline.last_busy() or any([o.val is not NULL for o in pipelined]):
+                    idle = False
+
+        for unit, write, fanout in self._register_fanouts:
+            old = unit.contents
+            write()
+            if not same(unit.contents, old):
+                idle = False
+                for c in fanout:
+                    dirty[c] = True
+
+        for unit, write in self._brams:
+            if idle and unit.i.val is not NULL and unit.iaddr.val is not NULL:
+                idle = False
+            write()
+
+        if idle:
+            self.skip_idle()
+
+    # Advances past the idle cycles that follow an idle cycle: each pipeline that still holds data
+    # shifts the NULL entries ahead of its first busy slot through
+    def skip_idle(self):
+        busy = [unit._pipeline for unit in self._pipelined if unit._n != 0]
+        if len(busy) == 0:
+            return
+
+        k = min([p.distance() for p in busy])
+        for p in busy:
+            p.advance(k)
+        self.clock_total += k
+        self.cycles_skipped += k
 
     def validate(self):
         if not self.validate_identifiers():
@@ -342,17 +1129,147 @@ class MockFPGA:
         if not self.validate_connections():
             print("validate_connections failed")
             exit(1)
-        if False and not self.validate_dag():
+        if not self.validate_dag():
             print("validate_dag failed")
             exit(1)
+        if not self.schedule():
+            print("schedule failed")
+            exit(1)
         return True
 
+    # The graph evaluation_order() and critical_chain() walk: the units that read each unit's Outputs
+    # within a cycle (see dependencies(): a BRAM only depends on oaddr within the cycle) and the units
+    # each gate's enable signal gates. Registers only drive the next cycle's values, so no edge leaves
+    # them. Returns the consumers and the drivers of every unit by index, or None (after printing why)
+    # if a unit reads an Output of a unit that was never added
+    def dependency_graph(self):
+        index = {id(u): k for k, u in enumerate(self.units)}
+        consumers = [[] for _ in self.units]
+        drivers = [[] for _ in self.units]
+
+        passed = True
+        for k, u in enumerate(self.units):
+            outputs = [i.output for i in u.dependencies()]
+            if id(u) in self._gates:
+                outputs.append(self._gates[id(u)])
+            for o in outputs:
+                driver = o.parent
+                if type(driver) is Register:
+                    continue
+                if id(driver) not in index:
+                    print(f"{o.name} is read by {u.name}, but {driver.name} was never added to the MockFPGA")
+                    passed = False
+                    continue
+                consumers[index[id(driver)]].append(k)
+                drivers[k].append(index[id(driver)])
+        return (consumers, drivers) if passed else None
+
+    # Kahn's algorithm over dependency_graph(). Registers are the sources: their outputs only depend
+    # on last cycle's contents, so they come first and their consumers don't have to wait on them.
+    # Returns the indices of the units in an order where each one comes after every unit driving its
+    # inputs, and for each unit the length of the longest chain of units ending with it and the unit
+    # before it on that chain. None (after printing why) if there is no such order
+    def topological_order(self):
+        graph = self.dependency_graph()
+        if graph is None:
+            return None
+        consumers, drivers = graph
+        indegree = [len(d) for d in drivers]
+
+        depth = [0 if type(u) is Register else 1 for u in self.units]
+        prev = [None for _ in self.units]
+        order = [k for k, u in enumerate(self.units) if type(u) is Register]
+        ready = deque([k for k, u in enumerate(self.units) if type(u) is not Register and indegree[k] == 0])
+        while ready:
+            k = ready.popleft()
+            order.append(k)
+            for c in consumers[k]:
+                if depth[k] + 1 > depth[c]:
+                    depth[c] = depth[k] + 1
+                    prev[c] = k
+                indegree[c] -= 1
+                if indegree[c] == 0:
+                    ready.append(c)
+
+        if len(order) != len(self.units):
+            # every unit left over still waits on another left over unit, so walking
+            # backwards through them has to run into a cycle
+            scheduled = set(order)
+            k = next(k for k in range(len(self.units)) if k not in scheduled)
+            path = []
+            seen = {}
+            while k not in seen:
+                seen[k] = len(path)
+                path.append(k)
+                k = next(d for d in drivers[k] if d not in scheduled)
+            cycle = [self.units[k].name for k in reversed(path[seen[k]:])]
+            print(f"Combinational cycle: {' -> '.join(cycle + cycle[:1])}")
+            return None
+        return order, depth, prev
+
+    # Orders the units so that each one is evaluated after every unit driving its inputs (see
+    # topological_order()). Returns the indices of the units in that order, or None (after printing
+    # why) if there is none
+    def evaluation_order(self, walk=None):
+        walk = walk or self.topological_order()
+        return walk[0] if walk is not None else None
+
+    # Builds the steps clock() runs from the evaluation order validate_dag() found (or loaded)
+    def schedule(self):
+        order = self._order if self._order is not None else self.evaluation_order()
+        if order is None:
+            return False
+
+        self._schedule = [self.units[k] for k in order]
+        self._storage = [u for u in self.units if type(u) is BRAM or type(u) is Register]
+        self._steps = [Gate(u, self._gates[id(u)], self.evaluator(u)) if id(u) in self._gates else self.evaluator(u)
+                       for u in self._schedule]
+        self._writers = [self.writer(u) for u in self._storage]
+        if self.profile:
+            if self.profiler is None:
+                import profiler
+                self.profiler = profiler.Profiler(self)
+            self.profiler.time_units()
+        if self.event_driven:
+            self.schedule_events()
+        if self.backend == "codegen":
+            import codegen
+            self._step = codegen.compile_step(self, self.codegen_path)
+        self.bind_ports()
+        return True
+
+    # precomputes which units have to be revisited when an Output changes value
+    def schedule_events(self):
+        self._registers = [u for u in self._schedule if type(u) is Register]
+        scheduled = [(u, step) for u, step in zip(self._schedule, self._steps) if type(u) is not Register]
+        position = {id(u): k for k, (u, _) in enumerate(scheduled)}
+
+        # gated units also have to see their enable signal change
+        gated = {}
+        for u, _ in scheduled:
+            if id(u) in self._gates:
+                gated.setdefault(id(self._gates[id(u)]), []).append(position[id(u)])
+
+        # Registers and BRAMs consume their inputs every cycle anyway
+        def fanout(o):
+            return [position[id(i.parent)] for i in o.inputs if isinstance(i.parent, Logic)] + gated.get(id(o), [])
+
+        self._events = []
+        for u, step in scheduled:
+            outputs = [u.o] if type(u) is BRAM else u._outputs
+            pipelined = None
+            if type(u) is not BRAM and len(u._pipeline) != 0:
+                pipelined = [o for o in u._outputs if o is not u.empty]
+            self._events.append((u, step, outputs, [fanout(o) for o in outputs], pipelined))
+
+        writers = {id(u): write for u, write in zip(self._storage, self._writers)}
+        self._register_fanouts = [(u, writers[id(u)], fanout(u.o)) for u in self._registers]
+        self._brams = [(u, writers[id(u)]) for u in self._storage if type(u) is BRAM]
+        self._dirty = [True for _ in scheduled]
+        self._pipelined = [u for u, _, _, _, pipelined in self._events if pipelined is not None]
+
     def validate_identifiers(self):
-        identifiers = []
-        [identifiers.extend(u.identifiers()) for u in self.units]
-        counts = {ident: 0 for ident in identifiers}
-        for ident in identifiers:
-            counts[ident] += 1
+        counts = Counter([ident for u in self.units for ident in u.identifiers()])
 
         passed = True
         for ident, c in counts.items():
@@ -361,11 +1278,90 @@ class MockFPGA:
                 print(f"{ident} is used {c} times (all identifiers should be unique)")
         return passed
 
+    # Checks that the units form no combinational cycle and finds the critical path: the longest chain
+    # of Logic units and BRAM reads evaluated one after the other within a cycle, from Register
+    # outputs (or constants) to Register and BRAM inputs. Both come out of one topological_order(),
+    # the walk schedule() orders the units with, so it is O(V+E). The result is cached under the
+    # netlist's hash in cache_dir together with the evaluation order, so a design that was already
+    # validated is also scheduled without building its graph again
     def validate_dag(self):
-        E = []
-        [E.extend(u.adjacencies()) for u in self.units]
-        return dfs(E)
-        
+        entry = None
+        if self.cache_dir is not None:
+            cache = os.path.join(self.cache_dir, f"netlist-v{CACHE_VERSION}-{self.netlist_hash()}")
+            try:
+                with open(cache, "rb") as fp:
+                    entry = pickle.load(fp)
+            except Exception:
+                entry = None # missing or unreadable, it is rebuilt
+
+        if entry is None:
+            walk = self.topological_order()
+            if walk is None:
+                return False
+            entry = (self.critical_chain(walk), self.evaluation_order(walk))
+            if self.cache_dir is not None:
+                self.write_cache(cache, entry)
+
+        path, self._order = entry
+        self.critical_path = path
+        if self.report_critical_path:
+            print(f"Critical path: {len(path)} units ({' -> '.join(path)})")
+        return True
+
+    # Writes entry to the cache file path through a temporary file of its own, so that processes
+    # validating the same design at once never see a partial entry. Failing to write only costs the
+    # next run the validation
+    def write_cache(self, path, entry):
+        tmp = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=os.path.basename(path) + ".")
+            with os.fdopen(fd, "wb") as fp:
+                pickle.dump(entry, fp)
+            os.replace(tmp, path)
+        except OSError:
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+    # names of the units on the longest combinational chain (see topological_order()), or None (after
+    # printing it) if there is a cycle
+    def critical_chain(self, walk=None):
+        walk = walk or self.topological_order()
+        if walk is None:
+            return None
+        _, depth, prev = walk
+
+        if len(self.units) == 0:
+            return []
+        k = max(range(len(self.units)), key=lambda k: depth[k])
+        path = []
+        while k is not None and type(self.units[k]) is not Register:
+            path.append(self.units[k].name)
+            k = prev[k]
+        return path[::-1]
+
+    # Hash of the design: every unit's type, name and pipeline depth, every connection and every gate
+    def netlist_hash(self):
+        lines = []
+        for u in self.units:
+            t = type(u)
+            if t is Register:
+                inputs = [u.i]
+                depth = 0
+            elif t is BRAM:
+                inputs = [u.i, u.iaddr, u.oaddr]
+                depth = 0
+            else:
+                inputs = u._inputs
+                depth = u._pipeline.depth
+            lines.append(f"{t.__name__} {u.name} {depth}")
+            for i in inputs:
+                lines.append(f"{i.output.name if i.output is not None else None} {i.name}")
+            if id(u) in self._gates:
+                lines.append(f"gate {self._gates[id(u)].name}")
+        lines.append("")
+        return hashlib.sha256("\n".join(lines).encode()).hexdigest()
+
     def validate_connections(self):
         passed = True
         for u in self.units:
@@ -377,55 +1373,26 @@ class MockFPGA:
         return passed
 
 def connect(o, i):
-    if type(o) is not Output:
+    if not isinstance(o, Output):
         raise TypeError("Connected output is not type Output()")
-    if type(i) is not Input:
+    if not isinstance(i, Input):
         raise TypeError("Connected input is not type Input()")
     if i.output is not None:
         raise ValueError(f"{i.name} already receiving output from {o.name}")
     o.inputs.append(i)
     i.output = o
 
-def dfs(E):
-    V = set()
-    for u, v in E:
-        V.add(u)
-        V.add(v)
-
-    adj = {u: [] for u in V}
-    for u, v in E:
-        adj[u].append(v)
-
-    color = {u: "w" for u in V}
-    pi = {u: None for u in V}
-    passed = True
-    cycled = {u: False for u in V}
-
-    def print_cycle(u):
-        if cycled[u]:
-            return
-        passed = False
-        msg = u
-        cur = pi[u]
-        while cur != u:
-            cycled[cur] = True
-            msg = f"{cur} -> {msg}"
-            cur = pi[cur]
-        print(msg)
-
-    def visit(u):
-        if color[u] == "g":
-            print_cycle(u)
-            return
-        color[u] = "g"
-        for v in adj[u]:
-                pi[v] = u
-                visit(v)
-        color[u] = "b"
-
-    for u in V:
-        if color[u] == "w":
-            visit(u)
-
-    return passed
 
+# connect() for a whole bus: outputs[k] drives inputs[k], or a single Output drives every Input.
+# InputArrays and OutputArrays can be passed as they are
+def connect_many(outputs, inputs):
+    if type(inputs) is InputArray:
+        inputs = inputs.inputs
+    if type(outputs) is OutputArray:
+        outputs = outputs.outputs
+    if isinstance(outputs, Output):
+        outputs = [outputs for _ in inputs]
+    elif len(outputs) != len(inputs):
+        raise ValueError(f"Connecting {len(outputs)} outputs to {len(inputs)} inputs")
+    for o, i in zip(outputs, inputs):
+        connect(o, i)
@@ -149,7 +149,7 @@ class PositionReader(Logic):
 
         stale_reference = True
         idx = 0
-        for cidx in neighborhood(cell_r):
+        for cidx in NEIGHBORHOOD[cell_r]:
             r = self.i[cidx].get()
             if r is NULL:
                 self.o[idx].set(NULL)
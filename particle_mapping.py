@@ -183,7 +183,7 @@ class PositionReader(Logic):
             return
 
         _stale_reference = True 
-        for cidx, o in zip(neighborhood(cell_r), self.o):
+        for cidx, o in zip(NEIGHBORHOOD[cell_r], self.o):
             i = self.i[cidx].get()
             if i is NULL:
                 o.set(NULL)
@@ -0,0 +1,256 @@
+from io import BytesIO
+from multiprocessing import get_context
+import pickle
+
+from hls import *
+
+'''
+MockFPGA that splits the design across worker processes. Registers cut the netlist into combinational
+pieces that only interact from one cycle to the next, which for the emulator means one piece per cell.
+
+* broadcast units only read Registers and other broadcast units (constants, the control unit, the
+  position read controller...). They are cheap and deterministic, so every process that needs one
+  evaluates its own copy.
+* reduction units only drive Registers but read several pieces (the And/Or trees that collect each
+  cell's done signals). The coordinator (the parent process) evaluates them.
+* what is left is grouped into connected pieces, which are handed out to the workers in contiguous
+  ranges of roughly equal size.
+
+Each cycle the coordinator sends every worker the Register contents it reads but can't compute itself,
+the workers evaluate their units and send back the Outputs that the coordinator needs, and the
+coordinator evaluates its units and writes the Registers it forwards. Values are pickled over pipes
+once per cycle.
+
+BRAM contents and most Registers only live in the workers. sync() copies them back before anything
+in the parent process reads them.
+'''
+
+def send(conn, obj):
+    fp = BytesIO()
+    Pickler(fp, pickle.HIGHEST_PROTOCOL).dump(obj)
+    conn.send_bytes(fp.getvalue())
+
+def recv(conn):
+    return Unpickler(BytesIO(conn.recv_bytes())).load()
+
+class PartitionedFPGA(MockFPGA):
+    def __init__(self, workers):
+        if workers < 1:
+            raise ValueError("PartitionedFPGA needs at least one worker")
+        super().__init__()
+        self.workers = workers
+        self._conns = None
+
+    def prepare(self):
+        if not self._init:
+            if self._conns is not None:
+                print("ERROR: units were added to a PartitionedFPGA after its workers started")
+                exit(1)
+            self.bind_tracer()
+            if not self.validate():
+                print("Validation of FPGA failed")
+                exit(1)
+            self.partition()
+            self._init = True
+
+    # the workers are forked with the state of this process, so a checkpoint has to be loaded first
+    def load(self, path):
+        if self._conns is not None:
+            raise ValueError("PartitionedFPGA can only load a checkpoint before its first clock()")
+        return super().load(path)
+
+    def clock(self):
+        self.prepare()
+        if self._conns is None:
+            self.start()
+
+        for conn, need in zip(self._conns, self._need[1:]):
+            send(conn, ("clock", [r.contents for r in need]))
+        for conn, exports in zip(self._conns, self._exports[1:]):
+            for o, val in zip(exports, self.receive(conn)):
+                o.val = val
+
+        for unit in self._reads[0]:
+            unit()
+        for step in self._local[0]:
+            step()
+        for write in self._writers[0]:
+            write()
+
+        self.clock_total += 1
+
+    def receive(self, conn):
+        try:
+            return recv(conn)
+        except EOFError:
+            print("ERROR: a PartitionedFPGA worker exited")
+            exit(1)
+
+    # copies the BRAM and Register contents held by the workers into this process
+    def sync(self):
+        if self._conns is None:
+            return
+        for conn in self._conns:
+            send(conn, ("sync", None))
+        for conn in self._conns:
+            for k, contents in self.receive(conn):
+                unit = self.units[k]
+                if type(unit) is BRAM:
+                    unit.contents[:] = contents
+                else:
+                    unit.contents = contents
+
+    # Assigns every unit to the processes that evaluate it (0 is the coordinator, 1..workers the workers)
+    def partition(self):
+        units = self.units
+        index = {id(u): k for k, u in enumerate(units)}
+        gates = self._gates
+
+        def inputs(u):
+            if type(u) is Register:
+                return []
+            i = [u.oaddr, u.i, u.iaddr] if type(u) is BRAM else list(u._inputs)
+            return [x.output for x in i] + ([gates[id(u)]] if id(u) in gates else [])
+
+        deps = [[index[id(o.parent)] for o in inputs(u)] for u in units]
+        consumers = [[] for _ in units]
+        for k, d in enumerate(deps):
+            for j in d:
+                consumers[j].append(k)
+        register = [type(u) is Register for u in units]
+
+        broadcast = set()
+        for u in self._schedule:
+            k = index[id(u)]
+            if isinstance(u, Logic) and all([register[j] or j in broadcast for j in deps[k]]):
+                broadcast.add(k)
+
+        reduction = set([k for k, u in enumerate(units)
+            if isinstance(u, Logic) and k not in broadcast and all([register[j] for j in consumers[k]])])
+
+        # connected pieces of everything else
+        parent = list(range(len(units)))
+        def find(k):
+            while parent[k] != k:
+                parent[k] = parent[parent[k]]
+                k = parent[k]
+            return k
+        piece = lambda k: not register[k] and k not in broadcast and k not in reduction
+        for k in range(len(units)):
+            if piece(k):
+                for j in deps[k]:
+                    if piece(j):
+                        parent[find(k)] = find(j)
+
+        # reductions that only read one piece belong to it
+        coordinator = []
+        for k in sorted(reduction):
+            roots = set([find(j) for j in deps[k] if piece(j)])
+            if len(roots) == 1 and not any([j in reduction for j in deps[k]]):
+                parent[k] = roots.pop()
+            else:
+                coordinator.append(k)
+        reduction = set(coordinator)
+
+        pieces = {}
+        for k in range(len(units)):
+            if not register[k] and k not in broadcast and k not in reduction:
+                pieces.setdefault(find(k), []).append(k)
+        pieces = sorted(pieces.values(), key=min)
+
+        # contiguous ranges of pieces with about the same number of units
+        workers = min(self.workers, len(pieces))
+        total = sum([len(p) for p in pieces])
+        U = [set(reduction)] + [set() for _ in range(workers)]
+        n = 0
+        for p in pieces:
+            w = min(workers - 1, n * workers // total)
+            U[w + 1].update(p)
+            n += len(p)
+
+        def close(S):
+            stack = list(S)
+            while len(stack):
+                for j in deps[stack.pop()]:
+                    if j in broadcast and j not in S:
+                        S.add(j)
+                        stack.append(j)
+        for S in U[1:]:
+            close(S)
+        for k in broadcast:
+            if sum([k in S for S in U[1:]]) != 1:
+                U[0].add(k)
+        close(U[0])
+
+        reads = [set([j for k in S for j in deps[k] if register[j]]) for S in U]
+        has = lambda p, j: j in U[p] or j in reads[p]
+
+        need = [[] for _ in U]
+        exports = [[] for _ in U]
+        writes = [set() for _ in U]
+        def export(o):
+            j = index[id(o.parent)]
+            if not has(0, j) and o not in exports[0]:
+                w = next(p for p in range(1, len(U)) if has(p, j))
+                exports[w].append(o)
+                exports[0].append(o)
+
+        for k in U[0]:
+            for o in inputs(units[k]):
+                export(o)
+        for r in [k for k in range(len(units)) if register[k]]:
+            driver = units[r].i.output
+            for p in range(len(U)):
+                if r not in reads[p]:
+                    continue
+                if has(p, index[id(driver.parent)]):
+                    writes[p].add(r)
+                else:
+                    need[p].append(units[r])
+                    writes[0].add(r)
+                    export(driver)
+        for p in range(1, len(U)):
+            writes[p].update([k for k in U[p] if type(units[k]) is BRAM])
+
+        in_order = lambda S: [step for u, step in zip(self._schedule, self._steps) if index[id(u)] in S and not register[index[id(u)]]]
+        self._local = [in_order(S) for S in U]
+        self._reads = [[units[k] for k in sorted(R)] for R in reads]
+        self._writes = [[units[k] for k in sorted(W)] for W in writes]
+        # what writes them, per process like the steps in _local (see MockFPGA.writer)
+        writers = {id(u): write for u, write in zip(self._storage, self._writers)}
+        self._writers = [[writers[id(u)] for u in W] for W in self._writes]
+        self._need = need
+        self._exports = exports
+
+        sizes = ", ".join([str(len(S)) for S in U[1:]])
+        print(f"Partitioned {len(units)} units over {workers} workers ({sizes} units), {len(U[0])} on the coordinator, "
+              f"{sum([len(n) for n in need])} registers and {len(exports[0])} outputs exchanged per cycle")
+
+    def start(self):
+        context = get_context("fork")
+        self._conns = []
+        for p in range(1, len(self._local)):
+            conn, child = context.Pipe()
+            context.Process(target=self.serve, args=(p, child), daemon=True).start()
+            self._conns.append(conn)
+
+    # worker process p
+    def serve(self, p, conn):
+        need, reads, local, writes, exports = self._need[p], self._reads[p], self._local[p], self._writes[p], self._exports[p]
+        writers = self._writers[p]
+        index = {id(u): k for k, u in enumerate(self.units)}
+        while True:
+            cmd, vals = recv(conn)
+            if cmd == "sync":
+                send(conn, [(index[id(u)], u.contents) for u in writes])
+                continue
+
+            for r, contents in zip(need, vals):
+                r.contents = contents
+            for unit in reads:
+                unit()
+            for step in local:
+                step()
+            send(conn, [o.val for o in exports])
+            for write in writers:
+                write()
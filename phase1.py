@@ -4,6 +4,7 @@ import sys
 
 from hls import *
 from common import *
+import common
 from compute_pipeline import ComputePipeline
 
 # PHASE 1: position cache read/filter write AND filter read/force evaluator write
@@ -14,18 +15,6 @@ from compute_pipeline import ComputePipeline
 # model
 
 
-# we use double buffering (every other phase we use the top half of the caches instead because of
-# particle transfers that happen in the motion update phase). This will provide a bit (0 or 1) that will give
-# an offset to add to all addresses used. 0 if it reads 0 and 256 if it reads 1
-#
-# e.g. if you're accessing address 13 of a givne BRAM, and the bit is 0, you will just access address 13
-# but if bit is 1, you will access address 13 + 256 = 269 instead.
-CTL_DOUBLE_BUFFER = Input 
-
-# Force evaluation control
-CTL_READY = Input # reads as 1 when force evaluation should begin/continue, otherwise 0
-CTL_DONE = Output # write 1 when your units are done evaluating forces, otherwise write 0
-
 class PositionReadController(Logic):
     def __init__(self):
         super().__init__("position-read-controller")
@@ -72,6 +61,11 @@ class PositionReadController(Logic):
                 else:
                     self.dispatch.set(False)
                     self.done.set(False)
+
+    # startup advances every cycle regardless of the inputs, and the dispatch it
+    # ends on has to be withdrawn the cycle after
+    def has_pending_work(self):
+        return self.ready.val is True and (self._startup < 2 or self.dispatch.val is True)
                 
 class PositionRingNode(Logic):
     def __init__(self,cell):
@@ -86,10 +80,10 @@ class PositionRingNode(Logic):
         self.next = Output(self,"next")
         self.bram_in = Input(self,"bram-in")
 
-        self._neighbor_buffer = [RESET for _ in range(NSIZE)]
+        self._neighbor_buffer = [RESET for _ in range(common.NSIZE)]
         self._i = 0
 
-        self.neighbors = [Output(self,f"neighbor-{i}") for i in range(NSIZE)]
+        self.neighbors = [Output(self,f"neighbor-{i}") for i in range(common.NSIZE)]
         self.reference = Output(self,"reference")
 
         self.addr = Output(self,"addr")
@@ -145,7 +139,7 @@ class PositionRingNode(Logic):
             # so when we write these to the neighbor registers,
             # we overwrite neighbors from last batch even if 
             # their cell didn't send anything
-            self._neighbor_buffer = [RESET for _ in range(NSIZE)]
+            self._neighbor_buffer = [RESET for _ in range(common.NSIZE)]
             self.reference.set(NULL)
             
             # fetch a new neighbor to be broadcasted
@@ -200,8 +194,8 @@ class PositionRingNode(Logic):
 
             next_ = RESET
             if prev is not NULL and self._cell != prev.cell:
-                if n3l_cell(self._cell, prev.cell):
-                    if self._i == NSIZE:
+                if common.HALF_SHELL[self._cell, prev.cell]:
+                    if self._i == common.NSIZE:
                         print(f"neighbor buffer overflow in node {self._cell}")
                         exit(1)
                     
@@ -217,6 +211,18 @@ class PositionRingNode(Logic):
         self.next.set(next_)
         self.done_all.set(self._done_all)
         self.done_batch.set(self._done_batch)
+
+    # The node only sits still once it is waiting out the end of a batch: every reference
+    # has been read and there is nothing to pass along the ring. A particle sent through the
+    # ring or to the pipelines must not be sent again either
+    def has_pending_work(self):
+        dispatch = self.dispatch.val
+        if dispatch is NULL:
+            return False
+        waiting = (dispatch is False and self._ptype == "r" and self._done_batch
+                   and self.bram_in.val is NULL and self.prev.val is NULL)
+        return (not waiting or self.reference.val is not NULL
+                or (self.next.val is not RESET and self.next.val is not NULL))
                 
 class VelocityRingNode(Logic):
     def __init__(self, cell):
@@ -263,6 +269,10 @@ class VelocityRingNode(Logic):
         else:
             self.next.set(RESET)
 
+    def has_pending_work(self):
+        return (len(self._queue_out) != 0 or len(self._queue_next) != 0
+                or self.fragment_out.val is not NULL or self.next.val is not RESET)
+
 
 class Adder(Logic):
     def __init__(self,i):
@@ -282,102 +292,144 @@ class Adder(Logic):
                 self.a.get() + self.b.get()
             ) 
 
-position_read_controller = m.add(PositionReadController())
-
-p_ring_nodes = [m.add(PositionRingNode(i)) for i in range(N_CELL)]
-p_ring_regs = [m.add(Register(f"p-ring-reg-{i}")) for i in range(N_CELL)]
-p_ring_addrs = [m.add(Register(f"p-ring-addr-{i}")) for i in range(N_CELL)]
-
-finished_batch = m.add(Register("finished-batch"))
-finished_batch_AND = m.add(And(N_CELL,"finished-batch-AND"))
-
-finished_all = m.add(Register("finished-all"))
-finished_all_AND = m.add(And(N_CELL,"finished-all-AND"))
-
-in_flight = m.add(Register("in-flight"))
-in_flight_OR = m.add(Or(N_CELL,"in-flight-AND"))
-
-compute_pipelines = [ComputePipeline(i, position_read_controller, m) for i in range(N_CELL)]
-
-v_ring_nodes = [m.add(VelocityRingNode(i)) for i in range(N_CELL)]
-v_ring_regs = [m.add(Register(f"v-ring-reg-{i}")) for i in range(N_CELL)]
-
-v_adders = [m.add(Adder(f"v-{i}")) for i in range(N_CELL)]
-
-# 1 signal from position read, N_CELL signals from compute pipelines,
-# and N_CELL signals from velocity ring nodes
-done = m.add(And(1 + N_CELL + N_CELL, "phase1-done-AND"))
-
-# position_read_controller inputs
-CTL_READY = position_read_controller.ready
-connect(finished_batch.o, position_read_controller.finished_batch)
-connect(finished_all.o, position_read_controller.finished_all)
-connect(in_flight.o, position_read_controller.in_flight)
-
-# p_ring_nodes inputs
-CTL_DOUBLE_BUFFER = [node.double_buffer for node in p_ring_nodes]
-
-for cell, cache, imux, omux, addr, node in zip(range(N_CELL), p_caches, p_imuxes, p_omuxes, p_ring_addrs, p_ring_nodes):
-    # p_ring_nodes inputs
-    connect(position_read_controller.dispatch, node.dispatch) 
-    connect(cache.o, node.bram_in)
-    connect(p_ring_regs[cell-1].o, node.prev)
-
-    # p_ring_regs inputs
-    connect(node.next, p_ring_regs[cell].i)
-
-    # p_ring_addrs inputs
-    connect(node.addr, addr.i)
-
-    # p_caches inputs
-    connect(null_const.o, imux.iaddr_phase1)
-    connect(null_const.o, imux.i_phase1)
-    connect(addr.o, omux.oaddr_phase1)
-
-# finished_{batch,all}_AND inputs
-for node, i_batch, i_all, i_in_flight in zip(p_ring_nodes, finished_batch_AND.i, finished_all_AND.i, in_flight_OR.i):
-    connect(node.done_batch, i_batch)
-    connect(node.done_all, i_all)
-    connect(node.in_flight, i_in_flight)
-
-# finished_{batch,all} inputs
-connect(finished_batch_AND.o, finished_batch.i)
-connect(finished_all_AND.o, finished_all.i)
-connect(in_flight_OR.o, in_flight.i)
-
-# compute_pipelines input
-for node, pipeline in zip(p_ring_nodes, compute_pipelines):
-    connect(node.reference, pipeline.reference)
-    for o, i in zip(node.neighbors, pipeline.neighbors):
-        connect(o,i)
-
-for cell, pipeline, node, adder, omux, cache, imux in zip(range(N_CELL), compute_pipelines, v_ring_nodes, v_adders, v_omuxes, v_caches, v_imuxes):
-    # v_ring_nodes inputs
-    connect(pipeline.neighbor_out, node.neighbor)
-    connect(pipeline.reference_out, node.reference)
-    connect(v_ring_regs[cell-1].o, node.prev)
-
-    # v_ring_regs inputs
-    connect(node.next, v_ring_regs[cell].i)
-
-    # v_adders inputs
-    connect(node.fragment_out, adder.a)
-    connect(cache.o, adder.b)
-
-    # v_caches inputs
-    connect(node.addr, omux.oaddr_phase1)
-    connect(node.addr, imux.iaddr_phase1)
-    connect(adder.o, imux.i_phase1)
-
-# done inputs
-i = 0
-connect(position_read_controller.done, done.i[i])
-i += 1
-for di in range(N_CELL):
-    connect(compute_pipelines[di].done, done.i[i+di])
-i += N_CELL
-for di in range(N_CELL):
-    connect(v_ring_nodes[di].rempty, done.i[i+di])
-
-# control_unit inputs
-CTL_DONE = done.o
+    def has_pending_work(self):
+        return False
+
+# N_CELL Adders evaluated as one unit (see hls.LogicArray). replica(k) has the same ports as an Adder.
+# The replicas with both operands set are picked out one by one, only their sum is a single numpy.add
+class AdderArray(LogicArray):
+    def __init__(self, name, n):
+        super().__init__(f"adder-{name}", n)
+
+        self.a = InputArray(self, "a", n)
+        self.b = InputArray(self, "b", n)
+        self.o = OutputArray(self, "o", n)
+
+    def logic(self):
+        a = self.a.get()
+        b = self.b.get()
+        o = [NULL for _ in range(self.n)]
+
+        valid = [k for k in range(self.n) if a[k] is not NULL and b[k] is not NULL]
+        if len(valid):
+            for k, v in zip(valid, numpy.add([a[k] for k in valid], [b[k] for k in valid])):
+                o[k] = v
+        self.o.set(o)
+
+    def has_pending_work(self):
+        return False
+
+# Phase 1 of the design, added to m and wired to the caches (a common.Caches)
+class Phase1:
+    def __init__(self, m, caches):
+        N_CELL = common.N_CELL
+        self.position_read_controller = position_read_controller = m.add(PositionReadController())
+
+        self.p_ring_nodes = p_ring_nodes = [m.add(PositionRingNode(i)) for i in range(N_CELL)]
+        self.p_ring_regs = p_ring_regs = [m.add(Register(f"p-ring-reg-{i}")) for i in range(N_CELL)]
+        p_ring_addrs = [m.add(Register(f"p-ring-addr-{i}")) for i in range(N_CELL)]
+
+        finished_batch = m.add(Register("finished-batch"))
+        finished_batch_AND = m.add(And(N_CELL,"finished-batch-AND"))
+
+        finished_all = m.add(Register("finished-all"))
+        finished_all_AND = m.add(And(N_CELL,"finished-all-AND"))
+
+        in_flight = m.add(Register("in-flight"))
+        in_flight_OR = m.add(Or(N_CELL,"in-flight-AND"))
+
+        self.compute_pipelines = compute_pipelines = [ComputePipeline(i, position_read_controller, m) for i in range(N_CELL)]
+
+        self.v_ring_nodes = v_ring_nodes = [m.add(VelocityRingNode(i)) for i in range(N_CELL)]
+        self.v_ring_regs = v_ring_regs = [m.add(Register(f"v-ring-reg-{i}")) for i in range(N_CELL)]
+
+        if common.args.vectorize:
+            v_adder_array = m.add(AdderArray("v", N_CELL))
+            v_adders = [v_adder_array.replica(i) for i in range(N_CELL)]
+        else:
+            v_adders = [m.add(Adder(f"v-{i}")) for i in range(N_CELL)]
+
+        # 1 signal from position read, N_CELL signals from compute pipelines,
+        # and N_CELL signals from velocity ring nodes
+        done = m.add(And(1 + N_CELL + N_CELL, "phase1-done-AND"))
+
+        # Force evaluation control: reads as 1 when force evaluation should begin/continue, otherwise 0
+        self.CTL_READY = position_read_controller.ready
+        connect(finished_batch.o, position_read_controller.finished_batch)
+        connect(finished_all.o, position_read_controller.finished_all)
+        connect(in_flight.o, position_read_controller.in_flight)
+
+        # we use double buffering (every other phase we use the top half of the caches instead because of
+        # particle transfers that happen in the motion update phase). This will provide a bit (0 or 1) that will give
+        # an offset to add to all addresses used. 0 if it reads 0 and 256 if it reads 1
+        #
+        # e.g. if you're accessing address 13 of a givne BRAM, and the bit is 0, you will just access address 13
+        # but if bit is 1, you will access address 13 + 256 = 269 instead.
+        self.CTL_DOUBLE_BUFFER = [node.double_buffer for node in p_ring_nodes]
+
+        for cell, cache, imux, omux, addr, node in zip(range(N_CELL), caches.p_caches, caches.p_imuxes, caches.p_omuxes, p_ring_addrs, p_ring_nodes):
+            # p_ring_nodes inputs
+            connect(position_read_controller.dispatch, node.dispatch) 
+            connect(cache.o, node.bram_in)
+            connect(p_ring_regs[cell-1].o, node.prev)
+
+            # p_ring_regs inputs
+            connect(node.next, p_ring_regs[cell].i)
+
+            # p_ring_addrs inputs
+            connect(node.addr, addr.i)
+
+            # p_caches inputs
+            connect(caches.null_const.o, imux.iaddr_phase1)
+            connect(caches.null_const.o, imux.i_phase1)
+            connect(addr.o, omux.oaddr_phase1)
+
+        # finished_{batch,all}_AND inputs
+        for node, i_batch, i_all, i_in_flight in zip(p_ring_nodes, finished_batch_AND.i, finished_all_AND.i, in_flight_OR.i):
+            connect(node.done_batch, i_batch)
+            connect(node.done_all, i_all)
+            connect(node.in_flight, i_in_flight)
+
+        # finished_{batch,all} inputs
+        connect(finished_batch_AND.o, finished_batch.i)
+        connect(finished_all_AND.o, finished_all.i)
+        connect(in_flight_OR.o, in_flight.i)
+
+        # compute_pipelines input
+        for node, pipeline in zip(p_ring_nodes, compute_pipelines):
+            connect(node.reference, pipeline.reference)
+            connect_many(node.neighbors, pipeline.neighbors)
+
+        for cell, pipeline, node, adder, omux, cache, imux in zip(range(N_CELL), compute_pipelines, v_ring_nodes, v_adders, caches.v_omuxes, caches.v_caches, caches.v_imuxes):
+            # v_ring_nodes inputs
+            connect(pipeline.neighbor_out, node.neighbor)
+            connect(pipeline.reference_out, node.reference)
+            connect(v_ring_regs[cell-1].o, node.prev)
+
+            # v_ring_regs inputs
+            connect(node.next, v_ring_regs[cell].i)
+
+            # v_adders inputs
+            connect(node.fragment_out, adder.a)
+            connect(cache.o, adder.b)
+
+            # v_caches inputs
+            connect(node.addr, omux.oaddr_phase1)
+            connect(node.addr, imux.iaddr_phase1)
+            connect(adder.o, imux.i_phase1)
+
+        # done inputs
+        i = 0
+        connect(position_read_controller.done, done.i[i])
+        i += 1
+        connect_many([pipeline.done for pipeline in compute_pipelines], done.i[i:i+N_CELL])
+        i += N_CELL
+        connect_many([node.rempty for node in v_ring_nodes], done.i[i:i+N_CELL])
+
+        # control_unit inputs: 1 when the units are done evaluating forces, otherwise 0
+        self.CTL_DONE = done.o
+
+        # units that are idle while CTL_READY is deasserted, and whose outputs are ignored (or NULL anyway) then
+        self.CTL_GATED = p_ring_nodes + v_ring_nodes + ([v_adder_array] if common.args.vectorize else v_adders)
+        for pipeline in compute_pipelines:
+            self.CTL_GATED += pipeline.logic_units
@@ -1,11 +1,6 @@
 from hls import *
 from common import *
-
-CTL_DOUBLE_BUFFER = []
-
-# Position update control
-CTL_READY = [] # reads as 1 when force evaluation should begin/continue, otherwise 0
-CTL_DONE = [] # write 1 when your units are done evaluating forces, otherwise write 0
+import common
 
 class PositionUpdateController(Logic):
     def __init__(self,cell):
@@ -55,6 +50,10 @@ class PositionUpdateController(Logic):
             if self._overwrite_addr == ndb(double_buffer) + DBSIZE:
                 self._overwrite_addr = NULL
                 self._raddr = db(double_buffer)
+
+    # walks the caches every cycle of phase 3
+    def has_pending_work(self):
+        return self.ready.val is True
         
 
 class PositionUpdater(Logic):
@@ -161,7 +160,7 @@ class PositionUpdater(Logic):
             return
         
         self.done.set(False)
-        new_p = (_pi + _vi*DT) % L
+        new_p = (_pi + _vi*DT) % common.L
         new_cell = cell_from_position(new_p)
         if(self.cell == new_cell):
             self.po.set(new_p)
@@ -181,46 +180,69 @@ class PositionUpdater(Logic):
             self.po.set(NULL)
             self.vo.set(NULL)
             self.nodeCellOut.set(new_cell)
-position_update_controller = [m.add(PositionUpdateController(cell)) for cell in range(N_CELL)]
-position_updater = [m.add(PositionUpdater(cell)) for cell in range(N_CELL)]
-
-ring_pos_reg =  [m.add(Register("ring_pos_"+str(cell))) for cell in range(N_CELL)]
-ring_vel_reg =  [m.add(Register("ring_vel_"+str(cell))) for cell in range(N_CELL)]
-ring_cell_reg =  [m.add(Register("ring_cell_"+str(cell))) for cell in range(N_CELL)]
-# position_update_controller inputs
-for i in range(N_CELL):
-    CTL_READY.append(position_update_controller[i].ready)
-    CTL_DOUBLE_BUFFER.append(position_update_controller[i].double_buffer)
-    CTL_READY.append(position_updater[i].ready)
-    CTL_DOUBLE_BUFFER.append(position_updater[i].double_buffer)
-    connect(position_update_controller[i].overwrite_addr, position_updater[i].overwrite_addr)
-    connect(v_caches[i].o, position_updater[i].vi)
-    connect(p_caches[i].o, position_updater[i].pi)
-    connect(position_update_controller[i].raddr, p_omuxes[i].oaddr_phase3)
-    connect(position_update_controller[i].raddr, v_omuxes[i].oaddr_phase3)
-    
-    
-    connect(position_updater[i].nodePosOut,ring_pos_reg[i].i)
-    connect(position_updater[i].nodeVelOut,ring_vel_reg[i].i)
-    connect(position_updater[i].nodeCellOut,ring_cell_reg[i].i)
-    
-    
-    
-    connect(ring_pos_reg[i].o,position_updater[(i+1)%N_CELL].nodePosIn)
-    connect(ring_vel_reg[i].o,position_updater[(i+1)%N_CELL].nodeVelIn)
-    connect(ring_cell_reg[i].o,position_updater[(i+1)%N_CELL].nodeCellIn)
-    
-    
-    connect(position_updater[i].block,position_update_controller[i].block)
-    
-    
-for imux, updater in zip(p_imuxes, position_updater):
-    connect(updater.iaddr, imux.iaddr_phase3)
-    connect(updater.po, imux.i_phase3)
-# v_cache inputs
-for imux, updater in zip(v_imuxes, position_updater):
-    connect(updater.iaddr, imux.iaddr_phase3)
-    connect(updater.vo, imux.i_phase3)
-
-# control_unit inputs
-CTL_DONE = [controller.done for controller in position_update_controller] + [updater.done for updater in position_updater]
+
+    # the particle held for the ring changes in logic() too, so checkpoints have to keep it
+    def state(self):
+        return {**super().state(), "nodePos": self.nodePos, "nodeVel": self.nodeVel, "nodeCell": self.nodeCell}
+
+    def has_pending_work(self):
+        return self.ready.val is True
+
+# Phase 3 of the design, added to m and wired to the caches (a common.Caches)
+class Phase3:
+    def __init__(self, m, caches):
+        N_CELL = common.N_CELL
+        position_update_controller = [m.add(PositionUpdateController(cell)) for cell in range(N_CELL)]
+        position_updater = [m.add(PositionUpdater(cell)) for cell in range(N_CELL)]
+
+        ring_pos_reg =  [m.add(Register("ring_pos_"+str(cell))) for cell in range(N_CELL)]
+        ring_vel_reg =  [m.add(Register("ring_vel_"+str(cell))) for cell in range(N_CELL)]
+        ring_cell_reg =  [m.add(Register("ring_cell_"+str(cell))) for cell in range(N_CELL)]
+        # buffered so the updater -> controller -> updater path is not a combinational cycle
+        block_reg = [m.add(Register("block_"+str(cell))) for cell in range(N_CELL)]
+
+        self.CTL_DOUBLE_BUFFER = []
+        # Position update control
+        self.CTL_READY = [] # reads as 1 when force evaluation should begin/continue, otherwise 0
+
+        # position_update_controller inputs
+        for i in range(N_CELL):
+            self.CTL_READY.append(position_update_controller[i].ready)
+            self.CTL_DOUBLE_BUFFER.append(position_update_controller[i].double_buffer)
+            self.CTL_READY.append(position_updater[i].ready)
+            self.CTL_DOUBLE_BUFFER.append(position_updater[i].double_buffer)
+            connect(position_update_controller[i].overwrite_addr, position_updater[i].overwrite_addr)
+            connect(caches.v_caches[i].o, position_updater[i].vi)
+            connect(caches.p_caches[i].o, position_updater[i].pi)
+            connect(position_update_controller[i].raddr, caches.p_omuxes[i].oaddr_phase3)
+            connect(position_update_controller[i].raddr, caches.v_omuxes[i].oaddr_phase3)
+            
+            
+            connect(position_updater[i].nodePosOut,ring_pos_reg[i].i)
+            connect(position_updater[i].nodeVelOut,ring_vel_reg[i].i)
+            connect(position_updater[i].nodeCellOut,ring_cell_reg[i].i)
+            
+            
+            
+            connect(ring_pos_reg[i].o,position_updater[(i+1)%N_CELL].nodePosIn)
+            connect(ring_vel_reg[i].o,position_updater[(i+1)%N_CELL].nodeVelIn)
+            connect(ring_cell_reg[i].o,position_updater[(i+1)%N_CELL].nodeCellIn)
+            
+            
+            connect(position_updater[i].block,block_reg[i].i)
+            connect(block_reg[i].o,position_update_controller[i].block)
+            
+            
+        for imux, updater in zip(caches.p_imuxes, position_updater):
+            connect(updater.iaddr, imux.iaddr_phase3)
+            connect(updater.po, imux.i_phase3)
+        # v_cache inputs
+        for imux, updater in zip(caches.v_imuxes, position_updater):
+            connect(updater.iaddr, imux.iaddr_phase3)
+            connect(updater.vo, imux.i_phase3)
+
+        # control_unit inputs: 1 when the units are done updating positions, otherwise 0
+        self.CTL_DONE = [controller.done for controller in position_update_controller] + [updater.done for updater in position_updater]
+
+        # units that are idle while CTL_READY is deasserted, and whose outputs are NULL then
+        self.CTL_GATED = position_update_controller + position_updater
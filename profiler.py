@@ -0,0 +1,132 @@
+from time import perf_counter
+
+from hls import *
+
+'''
+Per-unit profile of a MockFPGA, enabled with MockFPGA(profile=True). Once the netlist is scheduled,
+the unit evaluations are wrapped in timers. A MockFPGA without profiling runs exactly the same code
+as before, so leaving it off costs nothing.
+
+For each unit it records:
+* calls: how many times logic() ran (or, for Registers and BRAMs, how many times they were read)
+* total: time spent evaluating the unit, including its storage write
+* logic: time spent in logic(), including its Input.get() and Output.set() calls
+* ports: time spent in those Input.get() and Output.set() calls
+* engine: total - logic, the work the engine does around logic(): clearing and checking Outputs,
+  shifting the pipeline, driving empty, gating, and reading and writing storage
+
+Units are timed from the first clock() after they are added. The codegen backend inlines the
+engine work into step(), so it only has per-unit logic and ports times, and the time it spends
+outside logic() is reported for the whole cycle. Each timer call costs about as much as a short
+logic(), so compare units with each other rather than with runs that are not profiled.
+'''
+
+class Profiler:
+    def __init__(self, m):
+        self.m = m
+        self.stats = {} # id(unit) -> [calls, total, logic, ports]
+        self.cycles = 0
+        self.cycle_time = 0.0
+        m.clock = self.clock(m.clock)
+
+    # Times the units and the steps of a new schedule. Called by MockFPGA.schedule() before the
+    # schedule is used, so units added since the last schedule are picked up too
+    def time_units(self):
+        m = self.m
+        for unit in m.units:
+            if id(unit) in self.stats:
+                continue
+            stat = self.stats[id(unit)] = [0, 0.0, 0.0, 0.0]
+            if isinstance(unit, Logic):
+                unit.logic = self.timed(unit.logic, stat, 2)
+
+        # codegen.py recognizes units and Gates in the schedule and inlines the storage writes, so
+        # its steps are left alone
+        if m.backend != "codegen":
+            m._steps = [self.step(unit, step) for unit, step in zip(m._schedule, m._steps)]
+            m._writers = [self.write(unit, write) for unit, write in zip(m._storage, m._writers)]
+
+    # wraps f to add its run time to stat[k], counting calls if k is the logic() time
+    def timed(self, f, stat, k):
+        def call():
+            start = perf_counter()
+            f()
+            stat[k] += perf_counter() - start
+            if k == 2:
+                stat[0] += 1
+        return call
+
+    def step(self, unit, step):
+        stat = self.stats[id(unit)]
+        logic = isinstance(unit, Logic)
+        def call():
+            start = perf_counter()
+            step()
+            stat[1] += perf_counter() - start
+            if not logic:
+                stat[0] += 1
+        return call
+
+    # the storage write of unit at the end of the cycle, which counts towards its total
+    def write(self, unit, write):
+        stat = self.stats[id(unit)]
+        def call():
+            start = perf_counter()
+            write()
+            stat[1] += perf_counter() - start
+        return call
+
+    def clock(self, clock):
+        def call():
+            start = perf_counter()
+            clock()
+            self.cycle_time += perf_counter() - start
+            self.cycles += 1
+        return call
+
+    # Times the port calls made by logic(): f is Input.get() or Output.set() as the backend binds it,
+    # and the time goes to the unit the port belongs to. MockFPGA.bind_ports() binds the result on
+    # the ports of its Logic units
+    def port(self, f):
+        stats = self.stats
+        def call(port, *args):
+            start = perf_counter()
+            val = f(port, *args)
+            stat = stats.get(id(port.parent))
+            if stat is not None:
+                stat[3] += perf_counter() - start
+            return val
+        return call
+
+    # Prints the n units and n unit classes with the most total time (logic time for codegen)
+    def report(self, n):
+        codegen = self.m.backend == "codegen"
+        units = [(unit.name, type(unit).__name__, self.stats[id(unit)]) for unit in self.m.units if id(unit) in self.stats]
+        classes = {}
+        for _, cls, stat in units:
+            total = classes.setdefault(cls, [0, 0.0, 0.0, 0.0])
+            for k in range(4):
+                total[k] += stat[k]
+
+        key = lambda stat: stat[2] if codegen else stat[1]
+        seconds = lambda t: f"{'-' if codegen else f'{t:.3f}':>10}"
+        row = lambda name, stat: (f"{name:<40} {stat[0]:>10} {seconds(stat[1])} {stat[2]:>10.3f} "
+                                  f"{stat[3]:>10.3f} {seconds(stat[1] - stat[2])}")
+        header = lambda name: f"{name:<40} {'calls':>10} {'total (s)':>10} {'logic (s)':>10} {'ports (s)':>10} {'engine (s)':>10}"
+
+        print(f"PROFILE of {self.cycles} cycles ({self.cycle_time:.3f}s)")
+        print(header("unit"))
+        for name, _, stat in sorted(units, key=lambda u: key(u[2]), reverse=True)[:n]:
+            print(row(name, stat))
+        print(header("class"))
+        for cls, stat in sorted(classes.items(), key=lambda c: key(c[1]), reverse=True)[:n]:
+            print(row(cls, stat))
+
+        logic = sum([stat[2] for stat in classes.values()])
+        ports = sum([stat[3] for stat in classes.values()])
+        evaluated = sum([stat[1] for stat in classes.values()])
+        if codegen:
+            print(f"logic() {logic - ports:.3f}s, ports {ports:.3f}s, step() outside logic() {self.cycle_time - logic:.3f}s")
+        else:
+            print(f"logic() {logic - ports:.3f}s, ports {ports:.3f}s, engine around logic() {evaluated - logic:.3f}s, "
+                  f"rest of the cycle {self.cycle_time - evaluated:.3f}s")
@@ -0,0 +1,41 @@
+import argparse
+import contextlib
+import itertools
+import sys
+
+from system import Config, build_system, write_performance
+
+'''
+Runs emulator.py for every combination of the values given, one after another in this process (see
+system.py), and appends a row for each run to performance.csv:
+
+    python sweep.py -c 1 2 3 -p 1 2 3 4 -t 1 -n 300 -u 4 --codegen
+
+Options other than the ones below are passed to every run. The emulator's output goes to --log,
+which ends with the reason if a run fails.
+'''
+
+parser = argparse.ArgumentParser(usage="python sweep.py [-c CPAR ...] [-p PPAR ...] [-n N ...] [-u SIZE ...] [-t T] [-s SEED] [emulator options]")
+parser.add_argument("-c", "--cpar", type=int, nargs="+", default=[9])
+parser.add_argument("-p", "--ppar", type=int, nargs="+", default=[4])
+parser.add_argument("-n", "--particles", type=int, nargs="+", default=[300])
+parser.add_argument("-u", "--size", type=int, nargs="+", default=[3])
+parser.add_argument("-t", "--time", type=int, default=2)
+parser.add_argument("-s", "--seed", type=int, default=0)
+parser.add_argument("--log", default="sweep.log")
+args, options = parser.parse_known_args()
+
+points = list(itertools.product(args.cpar, args.ppar, args.particles, args.size))
+with open(args.log, "w") as log:
+    for k, (cpar, ppar, particles, size) in enumerate(points):
+        config = Config(cpar=cpar, ppar=ppar, time=args.time, particles=particles, size=size, seed=args.seed, options=options)
+        try:
+            with contextlib.redirect_stdout(log):
+                rows = build_system(config).run()
+        except SystemExit:
+            print(f"{' '.join(config.argv())} failed, see {args.log}")
+            sys.exit(1)
+        write_performance(rows)
+        for row in rows:
+            print(f"[{k + 1}/{len(points)}] {' '.join(config.argv())}: {row['cycles_total']} cycles, "
+                  f"max_err {row['max_err']:.3g}, {row['wall_s']:.2f}s ({row['build_s']:.2f}s building the netlist)")
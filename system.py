@@ -0,0 +1,169 @@
+import argparse
+import csv
+import gc
+import os
+import resource
+from dataclasses import dataclass, field
+
+'''
+Builds and runs the emulator from Python, so that one process can sweep many configurations:
+
+    from system import Config, build_system
+    for ppar in range(1, 7):
+        rows = build_system(Config(ppar=ppar, time=1, options=["--codegen"])).run()
+
+The options of emulator.py are parsed here, from the command line only by emulator.py's __main__
+(see parse_config()). Everything else describes a run with a Config.
+
+build_system() builds the design for a Config (an emulator.Emulator), which sets the parameters of
+common.py for it first (see common.configure()). Every System is built from the same modules and
+sets its Config again when it runs, so Systems built earlier still run as built. A System runs once.
+
+System.run() returns the rows emulator.py appends to performance.csv, and write_performance()
+appends them. peak_rss_mb is the peak resident memory since build_system() was called, which resets
+it (see reset_peak_rss()), or empty where the kernel doesn't allow that. It includes what the
+allocator kept of the memory earlier Systems freed, a few MB after a large UNIVERSE_SIZE.
+'''
+
+# the columns of performance.csv, see emulator.metrics()
+COLUMNS = ["N_PARTICLE", "N_CELL", "T", "N_CPAR", "N_PPAR", "cycles_total", "max_err", "seed", "wall_s", "build_s",
+           "phase1_s", "phase3_s", "verify_s", "cycles_per_s", "peak_rss_mb", "config_hash"]
+ROUNDED = {"wall_s": 3, "build_s": 3, "phase1_s": 3, "phase3_s": 3, "verify_s": 3, "cycles_per_s": 1, "peak_rss_mb": 1}
+
+parser = argparse.ArgumentParser(prog="emulator.py")
+varied = argparse.ArgumentParser(add_help=False) # the options parse_config() keeps in the fields of a Config
+for p in (parser, varied):
+    p.add_argument("-c","--cpar", type=int, default=9)
+    p.add_argument("-p","--ppar", type=int, default=4)
+    p.add_argument("-t","--time", type=int, default=2)
+    p.add_argument("-n","--particles", type=int, default=300)
+    p.add_argument("-u","--size", type=int, default=3)
+    p.add_argument("-s","--seed", type=int, default=0)
+parser.add_argument("--event-driven", action="store_true") # skip units whose inputs did not change
+parser.add_argument("--phase-gating", action="store_true") # skip each phase's units while the other phase runs
+parser.add_argument("--codegen", action="store_true") # evaluate cycles with a generated step() (see codegen.py)
+parser.add_argument("--fast-forward", action="store_true") # skip idle cycles in bulk (implies --event-driven)
+parser.add_argument("--workers", type=int, default=1) # evaluate the cells in this many processes (see partition.py)
+parser.add_argument("--vectorize", action="store_true") # evaluate the per-cell muxes and adders as LogicArrays
+parser.add_argument("--array-bram", action="store_true") # keep cache contents in numpy blocks allocated as they fill (see hls.ArrayStorage)
+parser.add_argument("--profile", type=int, default=0) # print the N units and unit classes that take the most time (see profiler.py)
+parser.add_argument("--trace", action="append", default=[]) # record the Outputs whose names match this glob (repeatable)
+parser.add_argument("--trace-file", default="trace.bin") # where --trace writes, convert it with vcd.py
+parser.add_argument("--counters", action="store_true") # append per-phase performance counters to counters.jsonl (see counters.py)
+parser.add_argument("--checkpoint", default=None) # save the emulator state to this file after every timestep
+parser.add_argument("--resume", default=None) # continue from a checkpoint saved with the same options (up to -t)
+parser.add_argument("--ensemble", type=int, default=1) # simulate seeds -s to -s + K - 1 on one netlist and summarize them
+parser.add_argument("--lj-table", type=int, default=0) # the force pipelines look LJ forces up in a table with this many bins per segment (see LJTable)
+parser.add_argument("--lj-segments", type=int, default=8) # segments of the LJ table, each covering half the r^2 of the one above it
+parser.add_argument("--lj-order", type=int, default=1) # order of the polynomial interpolated in each bin of the LJ table
+parser.add_argument("--verify-lj-table", action="store_true") # the verifier uses the LJ table too, instead of the exact forces
+parser.add_argument("--critical-path", action="store_true") # print the longest combinational chain of units when the FPGA starts
+
+# the options of emulator.py given by the command line arguments argv
+def parse_options(argv):
+    args = parser.parse_args(argv)
+    if args.ensemble > 1 and (args.workers > 1 or args.trace or args.counters or args.checkpoint is not None or args.resume is not None):
+        parser.error("--ensemble can not be combined with --workers, --trace, --counters, --checkpoint or --resume")
+    if args.verify_lj_table and not args.lj_table:
+        parser.error("--verify-lj-table needs --lj-table")
+    if args.workers > 1 and (args.event_driven or args.codegen or args.fast_forward or args.profile or args.trace or args.counters):
+        parser.error("--workers can not be combined with --event-driven, --codegen, --fast-forward, --profile, --trace or --counters")
+    return args
+
+# the options of emulator.py (see parser) that sweeps vary. Any other option goes in options
+@dataclass
+class Config:
+    cpar: int = 9 # N_CPAR
+    ppar: int = 4 # N_PPAR
+    time: int = 2 # T
+    particles: int = 300 # N_PARTICLE
+    size: int = 3 # UNIVERSE_SIZE
+    seed: int = 0 # SEED
+    options: list = field(default_factory=list) # e.g. ["--codegen", "--lj-table", "64"]
+
+    # the command line arguments emulator.py would be run with
+    def argv(self):
+        return ["-c", str(self.cpar), "-p", str(self.ppar), "-t", str(self.time), "-n", str(self.particles),
+                "-u", str(self.size), "-s", str(self.seed)] + list(self.options)
+
+    # all the options of emulator.py for this Config
+    def args(self):
+        return parse_options(self.argv())
+
+# the Config of the command line arguments argv, which exits with the usage if they are not valid
+# options of emulator.py
+def parse_config(argv):
+    parse_options(argv)
+    known, options = varied.parse_known_args(argv)
+    return Config(cpar=known.cpar, ppar=known.ppar, time=known.time, particles=known.particles, size=known.size,
+                  seed=known.seed, options=options)
+
+# Has the kernel start the peak resident memory (VmHWM) of this process over from its current RSS,
+# which Linux allows by writing 5 to clear_refs. Returns whether it did
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+        return True
+    except OSError:
+        return False
+
+# the peak resident memory of this process in MB, since the last reset_peak_rss()
+def peak_rss():
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class System:
+    def __init__(self, config, emulator, peak_reset):
+        self.config = config
+        self.emulator = emulator # an emulator.Emulator, the design wired up for config
+        self.m = emulator.m
+        self.peak_reset = peak_reset # whether peak_rss() only covers this System, see reset_peak_rss()
+        self._ran = False
+
+    # simulates the configured timesteps and returns a performance.csv row (a dict of COLUMNS) for
+    # each seed
+    def run(self):
+        if self._ran:
+            raise ValueError("a System can only run once, build another one for the next run")
+        self._ran = True
+        rows = self.emulator.metrics(self.emulator.run())
+        if not self.peak_reset:
+            for row in rows:
+                row["peak_rss_mb"] = None
+        return rows
+
+def build_system(config):
+    # the last design is only reachable through reference cycles, free it before building the next
+    gc.collect()
+    peak_reset = reset_peak_rss()
+
+    import emulator
+    return System(config, emulator.Emulator(config), peak_reset)
+
+# Appends rows (see System.run()) to path. A file from before the timing columns were added gets
+# them, empty for its rows
+def write_performance(rows, path="performance.csv"):
+    if os.path.exists(path):
+        with open(path, newline="") as fp:
+            header = fp.readline().rstrip("\r\n").split(",")
+        if header != COLUMNS:
+            with open(path, newline="") as fp:
+                old = list(csv.DictReader(fp))
+            with open(path, "w", newline="") as fp:
+                writer = csv.DictWriter(fp, COLUMNS, restval="", extrasaction="ignore", lineterminator="\n")
+                writer.writeheader()
+                writer.writerows(old)
+    else:
+        with open(path, "w") as fp:
+            print(",".join(COLUMNS), file=fp)
+    with open(path, "a", newline="") as fp:
+        writer = csv.DictWriter(fp, COLUMNS, lineterminator="\n")
+        for row in rows:
+            writer.writerow({k: round(v, ROUNDED[k]) if k in ROUNDED and v is not None else v for k, v in row.items()})
@@ -13,7 +13,7 @@ for cidx, reference_cache in enumerate(p_caches):
     for r in reference_cache.contents:
         if r is NULL:
             break
-        for nidx in neighborhood(cidx):
+        for nidx in NEIGHBORHOOD[cidx]:
             neighbor_cache = p_caches[nidx]
             for n in neighbor_cache.contents:
                 if n is NULL:
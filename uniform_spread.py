@@ -171,7 +171,7 @@ class PositionReader(Logic):
                     o.set(NULL)
                 continue
 
-            for o, cidx in zip(self.o[pidx], neighborhood(cell_r + pidx)):
+            for o, cidx in zip(self.o[pidx], NEIGHBORHOOD[cell_r + pidx]):
                 r = self.i[cidx].get()
                 if r is NULL:
                     o.set(NULL)
@@ -0,0 +1,14 @@
+import sys
+
+from hls import export_vcd
+
+'''
+Converts a trace recorded with emulator.py --trace into a VCD file for a waveform viewer such as GTKWave
+
+usage: python vcd.py trace.bin trace.vcd
+'''
+
+if len(sys.argv) != 3:
+    print("usage: python vcd.py TRACE VCD")
+    exit(1)
+export_vcd(sys.argv[1], sys.argv[2])
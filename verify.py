@@ -4,121 +4,177 @@ import math
 from math import inf
 
 from common import *
-import phase1
-
-CONTROL_UNIT = None
-
-filter_inputs = set()
-filter_expect = set()
-
-pipeline_inputs = set()
-pipeline_expect = set()
-
-target_positions = None
-
-def offst():
-    return CONTROL_UNIT._double_buffer * DBSIZE
-
-def compute_timestep(positions, velocities):
-    accelerations = [[numpy.zeros_like(r) for r in cell] for cell in positions]
-    for cell_r in range(N_CELL):
-        for addr_r, reference in enumerate(positions[cell_r]):
-            for cell_n in range(N_CELL):
-                for addr_n, neighbor in enumerate(positions[cell_n]):
-                    f = lj(reference,neighbor)
-                    accelerations[cell_r][addr_r] = accelerations[cell_r][addr_r] + f * DT
-                    
-                    r = Acceleration(cell = cell_r, addr = addr_r + offst(), a = reference)
-                    n = Acceleration(cell = cell_n, addr = addr_n + offst(), a = neighbor)
-                    pi = pair_ident(r,n)
-
-                    if n3l_cell(cell_r, cell_n):
-                        filter_expect.add(pi)    
-                    
-                    if norm(modr(reference, neighbor)) < CUTOFF and (cell_r != cell_n or addr_r != addr_n):
-                        pipeline_expect.add(pi)
-
-                    
-    new_positions = [[] for _ in range(N_CELL)]
-    new_velocities = [[] for _ in range(N_CELL)]
-
-    for cell in range(N_CELL):
-        for addr, _ in enumerate(accelerations[cell]):
-            velocities[cell][addr] += accelerations[cell][addr] * DT
-            new_position = (positions[cell][addr] + velocities[cell][addr] * DT) % L
-            new_cell = cell_from_position(new_position)
-            new_positions[new_cell].append(new_position)
-            new_velocities[new_cell].append(velocities[cell][addr])
-
-    positions = new_positions
-    velocities = new_velocities
-    return positions, velocities
-
-def extract_contents(caches, indicies = False, double_buffer = None):
-    return [[[i,x.copy()] if indicies else x.copy() for i,x in enumerate(cache.contents[offst():offst()+DBSIZE]) if x is not NULL] for cache in caches]
-
-def verify_emulator():
-    global target_positions
-    
-    positions = extract_contents(p_caches)
-    velocities = extract_contents(v_caches)
-  
-    for pi in filter_expect:
-        r, n = pi_to_p(pi)
-        print(f"expected {r} {n}")
-    if len(filter_expect):
-        print(f"Filter banks from last timestep did not recieve all expected inputs. {len(filter_expect)} missing")
-        exit(1)
-
-    for pi in pipeline_expect:
-        r, n = pi_to_p(pi)
-        print(f"expected {r} {n}")
-    if len(pipeline_expect):
-        print(f"Force pipelines from last timestep did not recieve all expected inputs. {len(pipeline_expect)} missing")
-        exit(1)
-
-    n_particle = sum([sum([r is not NULL for r in cache.contents[offst():offst()+DBSIZE]]) for cache in p_caches])
-    if n_particle != N_PARTICLE:
-        print(f"Particle count has changed from {N_PARTICLE} to {n_particle}")
-        exit(1)
-    
-    max_err = -inf
-    if target_positions is not None:
-        passed = True
-        for cell, P in enumerate(positions):
-            for addr_r, r in enumerate(P):
-                matched = False
-                min_err = inf
-                for T in target_positions:
-                    for addr_t, t in enumerate(T):
-                        err = norm(modr(r, t))/(norm(t)+ERR_TOLERANCE)
-                        if err < min_err:
-                            min_err = err
-                        if err < ERR_TOLERANCE:
-                            matched = True
-                            T.pop(addr_t)
-                            break
-                    if matched:
-                        break
-                if not matched:
-                    print(f"{cell}, {addr_r} could not be matched. Min err was {min_err}")
-                    passed = False
-                if min_err > max_err:
-                    max_err = min_err
-        if not passed:
-            print("Positions are incorrect")
+import common
+
+# Checks the emulator against the forces and positions it should compute, from the contents of the
+# caches (a common.Caches) when control_unit has finished a timestep. The filter banks and force
+# pipelines of compute_pipelines check every pair they receive against the pairs it expects
+class Verifier:
+    def __init__(self, control_unit, caches=None, compute_pipelines=()):
+        self.control_unit = control_unit
+        self.caches = caches
+
+        self.filter_inputs = set()
+        self.filter_expect = set()
+
+        self.pipeline_inputs = set()
+        self.pipeline_expect = set()
+
+        self.target_positions = None
+
+        # pairs are only tracked when the filter banks and force pipelines run in this process, so
+        # it is skipped with --workers
+        self.track_pairs = common.args.workers == 1
+
+        # the forces the verifier expects: exact unless --verify-lj-table, so that max_err shows the
+        # error of --lj-table
+        self.table = common.LJ_TABLE if common.args.verify_lj_table else None
+
+        for cp in compute_pipelines if self.track_pairs else []:
+            for f in cp.filter_bank:
+                f.input_set = self.filter_inputs
+                f.input_expect = self.filter_expect
+            cp.force_pipeline.input_set = self.pipeline_inputs
+            cp.force_pipeline.input_expect = self.pipeline_expect
+
+    def offst(self):
+        return self.control_unit._double_buffer * DBSIZE
+
+    def compute_timestep(self, positions, velocities):
+        N_CELL = common.N_CELL
+        # every particle, in the order of the caches, with its cell and its ident
+        P = numpy.array([r for cell in positions for r in cell]).reshape(-1, 3)
+        cells = numpy.array([cell for cell, rs in enumerate(positions) for _ in rs], dtype=int)
+        idents = numpy.array([cell*BSIZE + addr + self.offst() for cell, rs in enumerate(positions) for addr in range(len(rs))], dtype=int)
+
+        accelerations = [[] for _ in range(N_CELL)]
+        for k, reference in enumerate(P):
+            cell_r = cells[k]
+            # cumsum adds the forces up one pair at a time, in the same order as the pipelines see them
+            accelerations[cell_r].append(numpy.cumsum(lj_batch(reference, P, self.table) * DT, axis=0)[-1])
+
+            if self.track_pairs:
+                pis = common.N_IDENT*idents[k] + idents
+                self.filter_expect.update(pis[common.HALF_SHELL[cell_r, cells]].tolist())
+                near = norm(modr_batch(reference, P), axis=1) < CUTOFF
+                near[k] = False
+                self.pipeline_expect.update(pis[near].tolist())
+
+        new_positions = [[] for _ in range(N_CELL)]
+        new_velocities = [[] for _ in range(N_CELL)]
+
+        for cell in range(N_CELL):
+            for addr, _ in enumerate(accelerations[cell]):
+                velocities[cell][addr] += accelerations[cell][addr] * DT
+                new_position = (positions[cell][addr] + velocities[cell][addr] * DT) % common.L
+                new_cell = cell_from_position(new_position)
+                new_positions[new_cell].append(new_position)
+                new_velocities[new_cell].append(velocities[cell][addr])
+
+        positions = new_positions
+        velocities = new_velocities
+        return positions, velocities
+
+    def extract_contents(self, caches, indicies = False, double_buffer = None):
+        offst = self.offst()
+        if type(caches[0].contents) is ArrayStorage:
+            ret = []
+            for cache in caches:
+                data, valid = cache.contents.view(offst, offst+DBSIZE)
+                rows = list(data[valid]) # one copy per cache
+                ret.append([[i,x] for i,x in zip(numpy.flatnonzero(valid).tolist(), rows)] if indicies else rows)
+            return ret
+        return [[[i,x.copy()] if indicies else x.copy() for i,x in enumerate(cache.contents[offst:offst+DBSIZE]) if x is not NULL] for cache in caches]
+
+    def count_particles(self, caches):
+        offst = self.offst()
+        if type(caches[0].contents) is ArrayStorage:
+            return sum([numpy.count_nonzero(cache.contents.view(offst, offst+DBSIZE)[1]) for cache in caches])
+        return sum([sum([r is not NULL for r in cache.contents[offst:offst+DBSIZE]]) for cache in caches])
+
+    # writes the positions in the active half of the p_caches after timestep t (from 1) to records/t{t},
+    # which viz.py renders from t1 on
+    def record_positions(self, t):
+        offst = self.offst()
+        with open(join(dirname(__file__), "records", f"t{t}"), "wb") as fp:
+            for cache in self.caches.p_caches:
+                if type(cache.contents) is ArrayStorage:
+                    data, valid = cache.contents.view(offst, offst+DBSIZE)
+                    fp.write(data[valid].tobytes())
+                else:
+                    for r in cache.contents[offst:offst+DBSIZE]:
+                        if r is not NULL:
+                            fp.write(r.tobytes())
+
+    # what verify_emulator() carries from one timestep to the next, for checkpoints
+    def state(self):
+        return self.track_pairs, self.filter_expect, self.pipeline_expect, self.target_positions
+
+    def restore(self, state):
+        tracked, f, p, self.target_positions = state
+        if self.track_pairs and not tracked:
+            print("ERROR: the checkpoint was saved without pair tracking (--workers), so it can only be resumed with --workers")
+            exit(1)
+        self.filter_expect.clear()
+        self.filter_expect.update(f)
+        self.pipeline_expect.clear()
+        self.pipeline_expect.update(p)
+
+    # forgets what the last timestep expected, before other particles are placed in the caches
+    def reset(self):
+        self.restore((self.track_pairs, set(), set(), None))
+
+    def verify_emulator(self):
+        positions = self.extract_contents(self.caches.p_caches)
+        velocities = self.extract_contents(self.caches.v_caches)
+      
+        for pi in self.filter_expect:
+            r, n = pi_to_p(pi)
+            print(f"expected {r} {n}")
+        if len(self.filter_expect):
+            print(f"Filter banks from last timestep did not recieve all expected inputs. {len(self.filter_expect)} missing")
             exit(1)
 
-    pipeline_inputs.clear()
-    filter_inputs.clear()
-
-    target_positions, _ = compute_timestep(positions, velocities)
-
-    return max_err
+        for pi in self.pipeline_expect:
+            r, n = pi_to_p(pi)
+            print(f"expected {r} {n}")
+        if len(self.pipeline_expect):
+            print(f"Force pipelines from last timestep did not recieve all expected inputs. {len(self.pipeline_expect)} missing")
+            exit(1)
 
-for cp in phase1.compute_pipelines:
-    for f in cp.filter_bank:
-        f.input_set = filter_inputs
-        f.input_expect = filter_expect
-    cp.force_pipeline.input_set = pipeline_inputs
-    cp.force_pipeline.input_expect = pipeline_expect
+        n_particle = self.count_particles(self.caches.p_caches)
+        if n_particle != common.N_PARTICLE:
+            print(f"Particle count has changed from {common.N_PARTICLE} to {n_particle}")
+            exit(1)
+        
+        max_err = -inf
+        if self.target_positions is not None:
+            passed = True
+            targets = numpy.array([t for T in self.target_positions for t in T]).reshape(-1, 3)
+            scale = norm(targets, axis=1) + ERR_TOLERANCE
+            unmatched = numpy.ones(len(targets), dtype=bool)
+            for cell, P in enumerate(positions):
+                for addr_r, r in enumerate(P):
+                    # each position takes the first target left that is within tolerance
+                    left = numpy.flatnonzero(unmatched)
+                    err = norm(modr_batch(r, targets[left]), axis=1)/scale[left]
+                    within = numpy.flatnonzero(err < ERR_TOLERANCE)
+                    if len(within):
+                        min_err = err[:within[0] + 1].min()
+                        unmatched[left[within[0]]] = False
+                    else:
+                        min_err = err.min() if len(err) else inf
+                        print(f"{cell}, {addr_r} could not be matched. Min err was {min_err}")
+                        passed = False
+                    if min_err > max_err:
+                        max_err = min_err
+            if not passed:
+                print("Positions are incorrect")
+                exit(1)
+
+        self.pipeline_inputs.clear()
+        self.filter_inputs.clear()
+
+        self.target_positions, _ = self.compute_timestep(positions, velocities)
+
+        return max_err